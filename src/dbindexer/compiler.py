@@ -33,9 +33,10 @@ class SQLCompiler(BaseCompiler):
 
 
 class SQLInsertCompiler(BaseCompiler):
-    def execute_sql(self, return_id=False):
+    def get_insert_data(self):
+        # Called once per insert by execute_sql() and by bulk inserts
         resolver.convert_insert_query(self.query)
-        return super(SQLInsertCompiler, self).execute_sql(return_id=return_id)
+        return super(SQLInsertCompiler, self).get_insert_data()
 
 class SQLUpdateCompiler(BaseCompiler):
     pass
@@ -1,6 +1,7 @@
 from .db_settings import get_model_indexes
 from .utils import commit_locked
 from .expressions import ExpressionEvaluator
+from .multiquery import MergedQuery
 
 import datetime
 import sys
@@ -54,6 +55,22 @@ NEGATION_MAP = {
 
 NOT_PROVIDED = object()
 
+# Maximum number of entities the datastore accepts in one batch call
+MAX_BATCH_SIZE = 500
+
+# Columns of the unindexed fields, computed once per model
+_UNINDEXED_COLUMNS = {}
+
+def get_unindexed_columns(model):
+    try:
+        return _UNINDEXED_COLUMNS[model]
+    except KeyError:
+        opts = model._meta
+        columns = [opts.get_field(name).column
+                   for name in get_model_indexes(model)['unindexed']]
+        _UNINDEXED_COLUMNS[model] = columns
+        return columns
+
 def safe_call(func):
     @wraps(func)
     def _func(*args, **kwargs):
@@ -119,7 +136,7 @@ class GAEQuery(NonrelQuery):
                 continue
             yield self._make_entity(entity)
 
-        if executed and not isinstance(query, MultiQuery):
+        if executed and not isinstance(query, (MultiQuery, MergedQuery)):
             try:
                 self.query._gae_cursor = query.GetCompiledCursor()
             except:
@@ -129,8 +146,6 @@ class GAEQuery(NonrelQuery):
     def count(self, limit=NOT_PROVIDED):
         if self.pk_filters is not None:
             return len(self.get_matching_pk(0, limit))
-        if self.excluded_pks:
-            return len(list(self.fetch(0, 2000)))
         # The datastore's Count() method has a 'limit' kwarg, which has
         # a default value (obviously).  This value can be overridden to anything
         # you like, and importantly can be overridden to unlimited by passing
@@ -139,16 +154,43 @@ class GAEQuery(NonrelQuery):
         kw = {}
         if limit is not NOT_PROVIDED:
             kw['limit'] = limit
-        return self._build_query().Count(**kw)
+        if not self.excluded_pks:
+            return self._build_query().Count(**kw)
+        # Count() doesn't know about excluded pks, so the keys are counted
+        # here, skipping the excluded ones
+        limit = kw.get('limit')
+        count = 0
+        for key in self.iter_keys():
+            count += 1
+            if limit is not None and count >= limit:
+                break
+        return count
 
     @safe_call
     def delete(self):
         if self.pk_filters is not None:
             keys = [key for key in self.pk_filters if key is not None]
         else:
-            keys = self.fetch()
-        if keys:
-            Delete(keys)
+            keys = self.iter_keys()
+        # Keys are streamed to the datastore in fixed-size batches
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) == MAX_BATCH_SIZE:
+                Delete(batch)
+                batch = []
+        if batch:
+            Delete(batch)
+
+    def iter_keys(self):
+        """
+        Yields the keys of the matching entities, without fetching the
+        entity bodies
+        """
+        excluded = set(self.excluded_pks)
+        for key in self._build_keys_query().Run():
+            if key not in excluded:
+                yield key
 
     @safe_call
     def order_by(self, ordering):
@@ -240,9 +282,6 @@ class GAEQuery(NonrelQuery):
             self.inequality_field = column
         elif lookup_type == 'in':
             # Create sub-query combinations, one for each value
-            if len(self.gae_query) * len(value) > 30:
-                raise DatabaseError("You can't query against more than "
-                                    "30 __in filter value combinations")
             op_values = [('=', v) for v in value]
             self._combine_filters(column, db_type, op_values)
             return
@@ -320,9 +359,36 @@ class GAEQuery(NonrelQuery):
         for query in self.gae_query:
             query.Order(*self.gae_ordering)
         if len(self.gae_query) > 1:
+            if MergedQuery.can_merge(self.gae_query, self.gae_ordering):
+                return MergedQuery(self.db_table, self.gae_query,
+                                   self.gae_ordering)
+            if len(self.gae_query) > 30:
+                raise DatabaseError("You can't query against more than "
+                                    "30 __in filter value combinations "
+                                    "when ordering pks only queries")
             return MultiQuery(self.gae_query, self.gae_ordering)
         return self.gae_query[0]
 
+    def _build_keys_query(self):
+        """
+        Returns a keys only copy of the query. Cursors are kept, like in
+        __init__ they only apply to a single query, which keeps its ordering
+        because the cursors depend on it.
+        """
+        if len(self.gae_query) == 1:
+            keys_query = Query(self.db_table, keys_only=True,
+                cursor=getattr(self.query, '_gae_start_cursor', None),
+                end_cursor=getattr(self.query, '_gae_end_cursor', None))
+            keys_query.update(self.gae_query[0])
+            keys_query.Order(*self.gae_ordering)
+            return keys_query
+        queries = []
+        for query in self.gae_query:
+            keys_query = Query(self.db_table, keys_only=True)
+            keys_query.update(query)
+            queries.append(keys_query)
+        return MergedQuery(self.db_table, queries, [])
+
     def get_matching_pk(self, low_mark=0, high_mark=None):
         if not self.pk_filters:
             return []
@@ -457,12 +523,25 @@ class SQLCompiler(NonrelCompiler):
 class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
     @safe_call
     def insert(self, data, return_id=False):
+        key = Put(self.build_entity(data))
+        return key.id_or_name()
+
+    @safe_call
+    def insert_many(self, rows):
+        """
+        Inserts the rows, as returned by get_insert_data(), with batched Puts
+        of at most MAX_BATCH_SIZE entities and returns their ids in order
+        """
+        entities = [self.build_entity(data) for data in rows]
+        keys = []
+        for start in xrange(0, len(entities), MAX_BATCH_SIZE):
+            keys.extend(Put(entities[start:start + MAX_BATCH_SIZE]))
+        return [key.id_or_name() for key in keys]
+
+    def build_entity(self, data):
         gae_data = {}
         opts = self.query.get_meta()
-        unindexed_fields = get_model_indexes(self.query.model)['unindexed']
-        unindexed_cols = [opts.get_field(name).column
-                          for name in unindexed_fields]
-        kwds = {'unindexed_properties': unindexed_cols}
+        kwds = {'unindexed_properties': get_unindexed_columns(self.query.model)}
         for column, value in data.items():
             if column == opts.pk.column:
                 if isinstance(value, basestring):
@@ -478,8 +557,7 @@ class SQLInsertCompiler(NonrelInsertCompiler, SQLCompiler):
 
         entity = Entity(self.query.get_meta().db_table, **kwds)
         entity.update(gae_data)
-        key = Put(entity)
-        return key.id_or_name()
+        return entity
 
 class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
     def execute_sql(self, result_type=MULTI):
@@ -492,25 +570,54 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
         return len(pks)
 
     def update_entities(self, pks):
-        for pk in pks:
-            self.update_entity(pk[0])
+        gae_query = self.build_query()
+        values = self.prepare_values()
+        if [value for field, value in values if hasattr(value, 'evaluate')]:
+            # Expressions read the entity, so each one is updated in its own
+            # transaction
+            for pk in pks:
+                self.update_entity(pk[0], gae_query, values)
+            return
+        db_table = self.query.get_meta().db_table
+        keys = [create_key(db_table, pk[0]) for pk in pks]
+        for start in xrange(0, len(keys), MAX_BATCH_SIZE):
+            entities = [entity for entity in Get(keys[start:start + MAX_BATCH_SIZE])
+                        if entity is not None and gae_query.matches_filters(entity)]
+            for entity in entities:
+                self.apply_values(entity, values)
+            if entities:
+                Put(entities)
 
     @commit_locked
-    def update_entity(self, pk):
-        gae_query = self.build_query()
+    def update_entity(self, pk, gae_query=None, values=None):
+        if gae_query is None:
+            gae_query = self.build_query()
+        if values is None:
+            values = self.prepare_values()
         key = create_key(self.query.get_meta().db_table, pk)
         entity = Get(key)
         if not gae_query.matches_filters(entity):
             return
+        self.apply_values(entity, values)
+        key = Put(entity)
 
-        qn = self.quote_name_unless_alias
-        update_dict = {}
+    def prepare_values(self):
+        """
+        Returns the (field, value) pairs of the update, prepared for saving
+        """
+        values = []
         for field, o, value in self.query.values:
             if hasattr(value, 'prepare_database_save'):
                 value = value.prepare_database_save(field)
             else:
                 value = field.get_db_prep_save(value, connection=self.connection)
+            values.append((field, value))
+        return values
 
+    def apply_values(self, entity, values):
+        qn = self.quote_name_unless_alias
+        update_dict = {}
+        for field, value in values:
             if hasattr(value, "evaluate"):
                 assert not value.negated
                 assert not value.subtree_parents
@@ -528,8 +635,6 @@ class SQLUpdateCompiler(NonrelUpdateCompiler, SQLCompiler):
             db_type = field.db_type(connection=self.connection)
             entity[qn(field.column)] = self.convert_value_for_db(db_type, value)
 
-        key = Put(entity)
-
 class SQLDeleteCompiler(NonrelDeleteCompiler, SQLCompiler):
     pass
 
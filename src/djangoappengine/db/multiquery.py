@@ -0,0 +1,117 @@
+import heapq
+import itertools
+
+from google.appengine.api.datastore import Query
+from google.appengine.api.datastore_types import Key
+
+# Number of sub-queries started at once, before waiting for their first
+# results. This bounds the RPCs in flight without capping the number of
+# sub-queries.
+MAX_CONCURRENT_QUERIES = 30
+
+class _Head(object):
+    """
+    The next result of a sub-query, compared by the merge ordering and then
+    by key, like the datastore does.
+    """
+    def __init__(self, result, results, ordering):
+        self.result = result
+        self.results = results
+        self.ordering = ordering
+        self.key = result if isinstance(result, Key) else result.key()
+        self.values = [self._sort_value(name, direction)
+                       for name, direction in ordering]
+
+    def _sort_value(self, name, direction):
+        if name == '__key__':
+            return self.key
+        value = self.result.get(name)
+        # Multi-valued properties are sorted by their smallest value in
+        # ascending and by their largest value in descending order
+        if isinstance(value, list) and value:
+            if direction == Query.DESCENDING:
+                return max(value)
+            return min(value)
+        return value
+
+    def __cmp__(self, other):
+        for (name, direction), value, other_value in zip(self.ordering,
+                self.values, other.values):
+            result = cmp(value, other_value)
+            if result:
+                if direction == Query.DESCENDING:
+                    return -result
+                return result
+        return cmp(self.key, other.key)
+
+class MergedQuery(object):
+    """
+    Runs sub-queries concurrently and merges their sorted results with a
+    k-way heap merge, skipping duplicate keys. Limits and offsets are pushed
+    down to the sub-queries, which fetch at most offset + limit results each.
+
+    Implements the parts of the MultiQuery interface used by GAEQuery.
+    """
+    def __init__(self, kind, queries, ordering):
+        self.kind = kind
+        self.queries = queries
+        self.ordering = ordering
+
+    @staticmethod
+    def can_merge(queries, ordering):
+        # Keys only results don't carry the property values to merge on
+        if [query for query in queries if query.IsKeysOnly()]:
+            return not [name for name, direction in ordering
+                        if name != '__key__']
+        return True
+
+    def Run(self, offset=0, limit=None):
+        fetch = None
+        if limit is not None:
+            fetch = offset + limit
+        return itertools.islice(self._merge(fetch), offset, fetch)
+
+    def Get(self, limit, offset=0):
+        return list(self.Run(offset=offset, limit=limit))
+
+    def Count(self, limit=None):
+        """
+        Counts the distinct keys of the sub-queries, running them keys only
+        """
+        keys = set()
+        for query in self.queries:
+            keys_query = Query(self.kind, keys_only=True)
+            keys_query.update(query)
+            for key in self._run(keys_query, limit):
+                keys.add(key)
+                if limit is not None and len(keys) >= limit:
+                    return limit
+        return len(keys)
+
+    def _run(self, query, fetch):
+        if fetch is None:
+            return iter(query.Run())
+        return iter(query.Run(limit=fetch))
+
+    def _merge(self, fetch):
+        heap = []
+        for start in xrange(0, len(self.queries), MAX_CONCURRENT_QUERIES):
+            # Starting the batch first lets its RPCs run concurrently, the
+            # first results are only waited for afterwards
+            batch = [self._run(query, fetch) for query in
+                     self.queries[start:start + MAX_CONCURRENT_QUERIES]]
+            for results in batch:
+                self._push(heap, results)
+        seen = set()
+        while heap:
+            head = heapq.heappop(heap)
+            self._push(heap, head.results)
+            if head.key in seen:
+                continue
+            seen.add(head.key)
+            yield head.result
+
+    def _push(self, heap, results):
+        for result in results:
+            heapq.heappush(heap, _Head(result, results, self.ordering))
+            return
@@ -1,5 +1,13 @@
+import uuid
+import logging
+
+from google.appengine.api import memcache
+from google.appengine.api.datastore import Delete
+from google.appengine.api.datastore_types import Key
+from google.appengine.ext import deferred
 from google.appengine.datastore.datastore_query import Cursor
-from django.db import models, DEFAULT_DB_ALIAS
+from django.db import models, connections, DEFAULT_DB_ALIAS
+from django.db.models.sql.subqueries import InsertQuery
 try:
     from functools import wraps
 except ImportError:
@@ -33,6 +41,115 @@ def set_cursor(queryset, start=None, end=None):
     queryset.query._gae_end_cursor = end
     return queryset
 
+def bulk_insert(objs, using=DEFAULT_DB_ALIAS):
+    """
+    Inserts new model instances with batched datastore Puts (one batch per
+    model and at most 500 entities) and returns their primary keys in order.
+    The primary keys are set on the instances, too. Note that the instances'
+    save() methods are not called and no signals are sent.
+    """
+    connection = connections[using]
+    batches = {}
+    for index, obj in enumerate(objs):
+        pk_set = obj.pk is not None
+        values = [(field, field.get_db_prep_save(field.pre_save(obj, True),
+                                                 connection=connection))
+                  for field in obj._meta.local_fields
+                  if pk_set or not isinstance(field, models.AutoField)]
+        query = InsertQuery(obj.__class__)
+        query.insert_values(values)
+        compiler = query.get_compiler(using=using)
+        batch = batches.setdefault(obj.__class__, (compiler, []))
+        batch[1].append((index, compiler.get_insert_data()))
+    for compiler, rows in batches.values():
+        pks = compiler.insert_many([data for index, data in rows])
+        for (index, data), pk in zip(rows, pks):
+            obj = objs[index]
+            obj.pk = pk
+            obj._state.db = using
+            obj._state.adding = False
+            obj._entity_exists = True
+            obj._original_pk = pk
+    return [obj.pk for obj in objs]
+
+def bulk_delete(model, pks, batch_size=500):
+    """
+    Deletes the model's entities with the given primary keys using batched
+    datastore Deletes, without fetching them, and returns the number of
+    deleted keys. Note that the instances' delete() methods are not called,
+    no signals are sent and related objects are not collected.
+    """
+    db_table = model._meta.db_table
+    keys = [Key.from_path(db_table, pk) for pk in pks if pk is not None]
+    for start in xrange(0, len(keys), batch_size):
+        Delete(keys[start:start + batch_size])
+    return len(keys)
+
+def delete_queryset(queryset, batch_size=500):
+    """
+    Deletes the objects matching the queryset with a keys-only query and
+    batched datastore Deletes, and returns the number of deleted objects.
+    Unlike QuerySet.delete(), which loads every object to collect the
+    related ones, this never fetches the entities. Note that the instances'
+    delete() methods are not called, no signals are sent and related
+    objects are not collected.
+    """
+    model = queryset.model
+    deleted = 0
+    pks = []
+    for pk in queryset.values_list('pk', flat=True).iterator():
+        pks.append(pk)
+        if len(pks) == batch_size:
+            deleted += bulk_delete(model, pks, batch_size)
+            pks = []
+    return deleted + bulk_delete(model, pks, batch_size)
+
+DELETE_PROGRESS_KEY = 'djangoappengine-delete-%s'
+
+def deferred_delete(queryset, batch_size=500, queue='default'):
+    """
+    Deletes the objects matching the queryset in the background, one
+    keys-only batch per task, and returns the id of the deletion. Use
+    get_delete_progress() with the id to follow it. Note that the instances'
+    delete() methods are not called and no signals are sent.
+    """
+    delete_id = uuid.uuid4().hex
+    memcache.set(DELETE_PROGRESS_KEY % delete_id, {'deleted': 0, 'done': False})
+    deferred.defer(_delete_batch, queryset.model, queryset.query, delete_id,
+                   batch_size, _queue=queue)
+    return delete_id
+
+def get_delete_progress(delete_id):
+    """
+    Returns a dict with the number of deleted objects and whether the
+    deletion is done, or None if the progress is not known.
+    """
+    return memcache.get(DELETE_PROGRESS_KEY % delete_id)
+
+def _delete_batch(model, query, delete_id, batch_size, cursor=None, deleted=0,
+                  queue='default'):
+    queryset = model._default_manager.all()
+    queryset.query = query
+    queryset = queryset.values_list('pk', flat=True)
+    if cursor is not None:
+        queryset = set_cursor(queryset, start=cursor)
+    queryset = queryset[:batch_size]
+    pks = list(queryset)
+    deleted += bulk_delete(model, pks, batch_size)
+    done = len(pks) < batch_size
+    memcache.set(DELETE_PROGRESS_KEY % delete_id, {'deleted': deleted, 'done': done})
+    logging.info('Deferred delete %s of %s: %d deleted%s' % (
+        delete_id, model._meta.object_name, deleted, ', done' if done else ''))
+    if not done:
+        # Merged __in and exclude() queries have no cursor, they are run from
+        # the start again, the deleted objects don't match them anymore
+        if getattr(queryset.query, '_gae_cursor', None) is not None:
+            cursor = get_cursor(queryset)
+        else:
+            cursor = None
+        deferred.defer(_delete_batch, model, query, delete_id, batch_size,
+                       cursor, deleted, queue, _queue=queue)
+
 def commit_locked(func_or_using=None):
     """
     Decorator that locks rows on DB reads.
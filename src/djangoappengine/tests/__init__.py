@@ -1,8 +1,10 @@
 from .backend import BackendTest
 from .field_db_conversion import FieldDBConversionTest
 from .field_options import FieldOptionsTest
-from .filter import FilterTest
+from .filter import FilterTest, ExcludedCountTest, MergedQueryTest
 from .order import OrderTest
 from .not_return_sets import NonReturnSetsTest
 from .decimals import DecimalTest
 from .transactions import TransactionTest
+from .bulk import BulkInsertTest, BulkUpdateTest, BulkDeleteTest, \
+    DeferredDeleteTest
@@ -0,0 +1,162 @@
+from .testmodels import EmailModel, NullableTextModel
+from ..db import compiler
+from ..db.compiler import GAEQuery, get_unindexed_columns
+from ..db import utils
+from ..db.utils import bulk_insert, bulk_delete, delete_queryset, \
+    deferred_delete, get_delete_progress
+from django.db.models import F
+from django.test import TestCase
+from google.appengine.api.datastore_types import Key
+
+def insert_emails(count):
+    return bulk_insert([EmailModel(email='%d@example.com' % i, number=i)
+                        for i in range(count)])
+
+class SmallBatchTestCase(TestCase):
+    """
+    Runs the tests with a tiny MAX_BATCH_SIZE, so that a few entities
+    already take several datastore calls
+    """
+    def setUp(self):
+        self.batch_size = compiler.MAX_BATCH_SIZE
+        compiler.MAX_BATCH_SIZE = 2
+        self.wrapped = {}
+
+    def tearDown(self):
+        compiler.MAX_BATCH_SIZE = self.batch_size
+        for name, function in self.wrapped.items():
+            setattr(compiler, name, function)
+
+    def record_calls(self, name):
+        """
+        Records the calls of the compiler's datastore function, like Put,
+        and returns the list of the arguments they are called with
+        """
+        calls = []
+        function = getattr(compiler, name)
+        self.wrapped.setdefault(name, function)
+        def wrapper(arg, *args, **kwargs):
+            calls.append(arg)
+            return function(arg, *args, **kwargs)
+        setattr(compiler, name, wrapper)
+        return calls
+
+class BulkInsertTest(SmallBatchTestCase):
+    def test_ids_in_order(self):
+        objs = [EmailModel(email='%d@example.com' % i, number=i)
+                for i in range(5)]
+        pks = bulk_insert(objs)
+        self.assertEqual(pks, [obj.pk for obj in objs])
+        self.assertEqual([EmailModel.objects.get(pk=pk).number for pk in pks],
+                         range(5))
+
+    def test_chunked_puts(self):
+        puts = self.record_calls('Put')
+        pks = bulk_insert([NullableTextModel(text=str(i)) for i in range(5)])
+        self.assertEqual([len(entities) for entities in puts], [2, 2, 1])
+        self.assertEqual(len(set(pks)), 5)
+        self.assertEqual(NullableTextModel.objects.count(), 5)
+
+    def test_mixed_models(self):
+        objs = [EmailModel(email='a@example.com'), NullableTextModel(text='a'),
+                EmailModel(email='b@example.com')]
+        bulk_insert(objs)
+        self.assertEqual(EmailModel.objects.count(), 2)
+        self.assertEqual(NullableTextModel.objects.get(pk=objs[1].pk).text, 'a')
+
+    def test_saved_instances_are_updated(self):
+        obj = EmailModel(email='a@example.com')
+        bulk_insert([obj])
+        obj.number = 3
+        obj.save()
+        self.assertEqual(EmailModel.objects.count(), 1)
+        self.assertEqual(EmailModel.objects.get(pk=obj.pk).number, 3)
+
+    def test_unindexed_columns_are_cached(self):
+        self.assertTrue(get_unindexed_columns(EmailModel) is
+                        get_unindexed_columns(EmailModel))
+
+class BulkUpdateTest(SmallBatchTestCase):
+    def setUp(self):
+        super(BulkUpdateTest, self).setUp()
+        insert_emails(5)
+
+    def test_batched_update(self):
+        gets = self.record_calls('Get')
+        puts = self.record_calls('Put')
+        updated = EmailModel.objects.filter(number__gte=2).update(email='x@example.com')
+        self.assertEqual([len(keys) for keys in gets], [2, 1])
+        self.assertEqual([len(entities) for entities in puts], [2, 1])
+        self.assertEqual(updated, 3)
+        self.assertEqual(sorted(EmailModel.objects.filter(email='x@example.com')
+                                .values_list('number', flat=True)), [2, 3, 4])
+
+    def test_expression_update(self):
+        EmailModel.objects.filter(number__lt=2).update(number=F('number') + 10)
+        self.assertEqual(sorted(EmailModel.objects.values_list('number', flat=True)),
+                         [2, 3, 4, 10, 11])
+
+class BulkDeleteTest(SmallBatchTestCase):
+    def setUp(self):
+        super(BulkDeleteTest, self).setUp()
+        self.pks = insert_emails(5)
+
+    def test_batched_delete(self):
+        EmailModel.objects.filter(number__gte=1).delete()
+        self.assertEqual(list(EmailModel.objects.values_list('number', flat=True)), [0])
+
+    def test_bulk_delete(self):
+        self.assertEqual(bulk_delete(EmailModel, self.pks[:3]), 3)
+        self.assertEqual(sorted(EmailModel.objects.values_list('number', flat=True)), [3, 4])
+
+    def test_delete_queryset(self):
+        fetched = []
+        make_entity = GAEQuery.__dict__['_make_entity']
+        def _make_entity(query, entity):
+            if not isinstance(entity, Key):
+                fetched.append(entity)
+            return make_entity(query, entity)
+        GAEQuery._make_entity = _make_entity
+        try:
+            deleted = delete_queryset(EmailModel.objects.filter(number__gte=1),
+                                      batch_size=2)
+        finally:
+            GAEQuery._make_entity = make_entity
+        self.assertEqual(deleted, 4)
+        self.assertEqual(fetched, [])
+        self.assertEqual(list(EmailModel.objects.values_list('number', flat=True)), [0])
+
+class RunDeferred(object):
+    """
+    Replaces the deferred module in db.utils, so the tasks run immediately
+    """
+    @staticmethod
+    def defer(function, *args, **kwargs):
+        kwargs = dict((name, value) for name, value in kwargs.items()
+                      if not name.startswith('_'))
+        return function(*args, **kwargs)
+
+class DeferredDeleteTest(TestCase):
+    def setUp(self):
+        insert_emails(5)
+        self.deferred = utils.deferred
+        utils.deferred = RunDeferred
+
+    def tearDown(self):
+        utils.deferred = self.deferred
+
+    def test_deferred_delete(self):
+        delete_id = deferred_delete(EmailModel.objects.filter(number__gte=1),
+                                    batch_size=2)
+        self.assertEqual(get_delete_progress(delete_id), {'deleted': 4, 'done': True})
+        self.assertEqual(list(EmailModel.objects.values_list('number', flat=True)), [0])
+
+    def test_deferred_delete_without_cursor(self):
+        # __in queries are merged, so the batches can't continue from a cursor
+        delete_id = deferred_delete(EmailModel.objects.filter(number__in=[0, 2, 4]),
+                                    batch_size=2)
+        self.assertEqual(get_delete_progress(delete_id), {'deleted': 3, 'done': True})
+        self.assertEqual(sorted(EmailModel.objects.values_list('number', flat=True)), [1, 3])
+
+    def test_unknown_delete_progress(self):
+        self.assertEqual(get_delete_progress('unknown'), None)
@@ -1,4 +1,5 @@
 from ..db.utils import get_cursor, set_cursor
+from .bulk import insert_emails
 from .testmodels import FieldsWithOptionsModel, EmailModel, DateTimeModel, \
     OrderedModel, BlobModel
 from django.db import models
@@ -439,3 +440,45 @@ class FilterTest(TestCase):
         self.assertEqual(e['data'], x.data)
         x = BlobModel.objects.all()[0]
         self.assertEqual(e['data'], x.data)
+
+class ExcludedCountTest(TestCase):
+    def setUp(self):
+        self.pks = insert_emails(5)
+
+    def test_count_excluded(self):
+        query = EmailModel.objects.filter(number__gte=1)
+        # pks[0] doesn't match the filter anyway
+        self.assertEqual(query.exclude(pk__in=self.pks[:2]).count(), 3)
+
+    def test_count_excluded_with_limit(self):
+        query = EmailModel.objects.exclude(pk__in=self.pks[:2])
+        self.assertEqual(query[:2].count(), 2)
+        self.assertEqual(query[:10].count(), 3)
+
+    def test_count_excluded_with_cursor(self):
+        query = EmailModel.objects.order_by('number')
+        cursor = get_cursor(query[:2])
+        query = set_cursor(query, cursor).exclude(pk__in=self.pks[4:])
+        self.assertEqual(query.count(), 2)
+
+class MergedQueryTest(TestCase):
+    def setUp(self):
+        insert_emails(40)
+
+    def test_in_ordering_and_limits(self):
+        query = EmailModel.objects.filter(number__in=range(0, 40, 2)).order_by('-number')
+        self.assertEqual([obj.number for obj in query[:3]], [38, 36, 34])
+        self.assertEqual([obj.number for obj in query[2:4]], [34, 32])
+        self.assertEqual(query.count(), 20)
+
+    def test_more_than_30_combinations(self):
+        query = EmailModel.objects.filter(number__in=range(35)).order_by('number')
+        self.assertEqual([obj.number for obj in query], range(35))
+
+    def test_duplicate_values(self):
+        query = EmailModel.objects.filter(number__in=[1, 1, 2]).order_by('number')
+        self.assertEqual([obj.number for obj in query], [1, 2])
+
+    def test_negated_exact(self):
+        query = EmailModel.objects.exclude(number=2).order_by('number')
+        self.assertEqual([obj.number for obj in query[:4]], [0, 1, 3, 4])
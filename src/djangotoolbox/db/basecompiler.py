@@ -359,6 +359,12 @@ class NonrelCompiler(SQLCompiler):
 
 class NonrelInsertCompiler(object):
     def execute_sql(self, return_id=False):
+        return self.insert(self.get_insert_data(), return_id=return_id)
+
+    def get_insert_data(self):
+        """
+        Returns the query values as a dict of column names to database values
+        """
         data = {}
         for (field, value), column in zip(self.query.values, self.query.columns):
             if field is not None:
@@ -368,7 +374,7 @@ class NonrelInsertCompiler(object):
                 db_type = field.db_type(connection=self.connection)
                 value = self.convert_value_for_db(db_type, value)
             data[column] = value
-        return self.insert(data, return_id=return_id)
+        return data
 
     def insert(self, values, return_id):
         """
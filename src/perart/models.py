@@ -4,7 +4,9 @@ __date__      = '24 January 2010'
 __copyright__ = 'Copyright (c) 2010 Viktor Kerkez'
 
 import re
+import time
 import string
+import hashlib
 import logging
 
 from google.appengine.ext import db
@@ -15,6 +17,11 @@ from django.db import models
 from django.core.urlresolvers import reverse
 from django.template.defaultfilters import slugify
 from djangotoolbox.fields import BlobField
+from djangoappengine.db.utils import bulk_insert, bulk_delete, get_cursor, set_cursor
+from tea.dsa.lru import LRUCache
+from tea.gae.rpc import RpcCounter
+from tea.gae.cache import invalidate as invalidate_pages, versions as page_versions
+from tea.django import memo
 
 # Constant for fetching all objects from db
 FETCH_ALL = 1000
@@ -27,6 +34,9 @@ class PerartModel(object):
     
     @classmethod
     def name(cls):
+        # Querysets using only() return instances of deferred subclasses
+        if getattr(cls, '_deferred', False):
+            cls = cls._meta.proxy_for_model
         return cls.__name__
 
     @classmethod
@@ -44,44 +54,111 @@ class PerartModel(object):
         return reverse('perart.admin.%s.delete' % self.name().lower(), args=[self.id])
 
 
+class UrlReservationError(Exception):
+    def __init__(self, url):
+        self.url = url
+
+    def __repr__(self):
+        return u'Unable to reserve an url for: %s' % self.url
+    __unicode__ = __str__ = __repr__
+
+
 class PerartModelWithTitleAndUrl(PerartModel):
+    URL_CACHE_KEY = '%s-%s'
+    # Missing urls are cached for a short time only, so new objects show up
+    # even if some instance missed the invalidation
+    URL_MISS_CACHE_TIME = 60
+    URL_MISS = '__missing__'
+    # Process local cache in front of memcache, it's not invalidated across
+    # instances so entries expire quickly
+    _url_cache = LRUCache(256, ttl=30)
+    # Urls given to new objects are reserved for a while, so the concurrent
+    # saves don't pick them before the objects are visible in queries
+    URL_RESERVATION_KEY      = 'url-reservation-%s-%s'
+    URL_RESERVATION_TIME     = 60
+    URL_RESERVATION_ATTEMPTS = 10
+
     def __unicode__(self):
         return self.title    
 
+    @classmethod
+    def url_cache_key(cls, url):
+        return cls.URL_CACHE_KEY % (cls.name(), url)
+
     @classmethod
     def get_by_url(cls, url):
-        obj = None #memcache.get('%s-%s' % (cls.name(), url)) #@UndefinedVariable
+        key = cls.url_cache_key(url)
+        obj = cls._url_cache.get(key)
         if obj is None:
-            try:
-                obj = cls.objects.get(url=url)
-                memcache.set('%s-%s' % (cls.name(), url), obj) #@UndefinedVariable
-            except cls.DoesNotExist: pass
-        return obj
+            obj = memcache.get(key) #@UndefinedVariable
+            if obj is None:
+                try:
+                    obj = cls.objects.get(url=url)
+                    memcache.set(key, obj) #@UndefinedVariable
+                except cls.DoesNotExist:
+                    obj = cls.URL_MISS
+                    memcache.set(key, obj, time=cls.URL_MISS_CACHE_TIME) #@UndefinedVariable
+            cls._url_cache.set(key, obj)
+        return None if obj == cls.URL_MISS else obj
+
+    @classmethod
+    def invalidate_url(cls, *urls):
+        keys = [cls.url_cache_key(url) for url in urls if url]
+        for key in keys:
+            cls._url_cache.delete(key)
+        memcache.delete_multi(keys) #@UndefinedVariable
 
     @classmethod
     def get_unique_url(cls, old_url, title):
         '''Function takes in an url and checks if it's already used.
         
-        If the url already exists then adds a number to the end of the url.
+        If the url already exists then adds the first free number to the end
+        of the url. All used urls are fetched with a single prefix query, and
+        the chosen url is reserved in memcache, so concurrent saves of objects
+        with the same title don't end up with the same url. Reservation is
+        released once the object is saved. UrlReservationError is raised if
+        no url could be reserved in URL_RESERVATION_ATTEMPTS attempts.
         '''
         url = unicode(slugify(title))
-        if url == old_url: return url
+        pattern = re.compile(u'^%s(?:-(\\d+))?$' % re.escape(url))
+        if old_url and pattern.match(old_url): return old_url
+        used = set()
+        for existing in cls.objects.filter(url__startswith=url).values_list('url', flat=True):
+            match = pattern.match(existing)
+            if match:
+                used.add(int(match.group(1) or 0))
         nr = 0
-        obj = cls.get_by_url(url)
-        while obj:
+        attempts = cls.URL_RESERVATION_ATTEMPTS
+        while attempts > 0:
+            if nr not in used:
+                candidate = url if nr == 0 else u'%s-%s' % (url, nr)
+                attempts -= 1
+                if memcache.add(cls.reservation_key(candidate), True, #@UndefinedVariable
+                                time=cls.URL_RESERVATION_TIME):
+                    return candidate
             nr += 1
-            url = '%s-%s' % (url, nr)
-            obj = cls.get_by_url(url)
-        return url
+        raise UrlReservationError(url)
+
+    @classmethod
+    def reservation_key(cls, url):
+        return cls.URL_RESERVATION_KEY % (cls.name(), url)
 
     def save(self, *args, **kwargs):
+        old_url = self.url
         self.url = self.get_unique_url(self.url, self.title)
-        # Must be set after put, because the unputed is saved in memcache!!!
-        #memcache.set('%s-%s' % (self.__class__.name(), self.url), self) #@UndefinedVariable
+        super(PerartModelWithTitleAndUrl, self).save(*args, **kwargs)
+        if self.url != old_url:
+            # The object is saved, so the url doesn't need the reservation
+            memcache.delete(self.reservation_key(self.url)) #@UndefinedVariable
+        # Must be invalidated after put, the old url is removed too, in case
+        # the title change renamed the url
+        self.invalidate_url(old_url, self.url)
+        invalidate_pages(self.name().lower())
 
     def delete(self):
-        memcache.delete('%s-%s' % (self.__class__.name(), self.url)) #@UndefinedVariable
         super(PerartModelWithTitleAndUrl, self).delete()
+        self.invalidate_url(self.url)
+        invalidate_pages(self.name().lower())
 
 
 
@@ -97,15 +174,101 @@ class MenuParseError(Exception):
 
 
 class Menu(PerartModel, models.Model):
+    VERSION_CACHE_KEY  = 'menu-version-%s'
+    COMPILED_CACHE_KEY = 'menu-compiled-%s'
+    HTML_CACHE_KEY     = 'menu-html-%s'
+    # Maximum number of menus kept in the process local caches
+    LOCAL_CACHE_SIZE = 64
     FIELD_LIST = [
         {'name': 'title', 'width': 350},
     ]
     
     title   = models.CharField(max_length=511)
     text    = models.TextField(null=True, blank=True)
-    
+
+    # Process local caches of compiled and rendered menus, keyed by menu version
+    _compiled = LRUCache(LOCAL_CACHE_SIZE)
+    _html     = LRUCache(LOCAL_CACHE_SIZE)
+
+    def version(self):
+        '''Menu version is the hash of the menu text'''
+        return hashlib.md5((self.text or u'').encode('utf-8')).hexdigest()
+
+    @classmethod
+    def _get_cached(cls, local, key, version):
+        value = local.get(version)
+        if value is None:
+            value = memcache.get(key % version) #@UndefinedVariable
+            if value is not None:
+                cls._set_cached(local, key, version, value, False)
+        return value
+
+    @classmethod
+    def _set_cached(cls, local, key, version, value, shared=True):
+        if shared:
+            memcache.set(key % version, value) #@UndefinedVariable
+        local.set(version, value)
+
+    def compile(self):
+        '''Returns the compiled menu tree, parsing the text only on a cache miss'''
+        version = self.version()
+        compiled = Menu._get_cached(Menu._compiled, Menu.COMPILED_CACHE_KEY, version)
+        if compiled is None:
+            compiled = MenuItem.compile(self.text or '')
+            Menu._set_cached(Menu._compiled, Menu.COMPILED_CACHE_KEY, version, compiled)
+        return compiled
+
+    def render(self):
+        '''Returns the rendered menu html, menu must not have G or P links'''
+        version = self.version()
+        html = Menu._get_cached(Menu._html, Menu.HTML_CACHE_KEY, version)
+        if html is None:
+            html = MenuItem.build(self.compile(), {}).spitout()
+            Menu._set_cached(Menu._html, Menu.HTML_CACHE_KEY, version, html)
+        return html
+
+    @classmethod
+    def get_version(cls, title):
+        version = memcache.get(cls.VERSION_CACHE_KEY % title) #@UndefinedVariable
+        if version is None:
+            version = cls.objects.get(title=title).version()
+            memcache.set(cls.VERSION_CACHE_KEY % title, version) #@UndefinedVariable
+        return version
+
+    @classmethod
+    def get_html(cls, title):
+        '''Returns the rendered html of the menu with the given title'''
+        html = cls._get_cached(cls._html, cls.HTML_CACHE_KEY, cls.get_version(title))
+        if html is None:
+            html = cls.objects.get(title=title).render()
+        return html
+
     def create(self, data=None):
-        return MenuItem.create(self.text, data or {})
+        return MenuItem.build(self.compile(), data or {})
+
+    def invalidate(self, titles):
+        keys = [Menu.VERSION_CACHE_KEY % title for title in titles]
+        for program in Program.objects.filter(menu=self):
+            keys.extend(program.menu_cache_keys())
+        memcache.delete_multi(keys) #@UndefinedVariable
+        invalidate_pages('menu')
+
+    def save(self, *args, **kwargs):
+        titles = set([self.title])
+        if self.id is not None:
+            try:
+                titles.add(Menu.objects.get(pk=self.id).title)
+            except Menu.DoesNotExist: pass
+        models.Model.save(self, *args, **kwargs)
+        self.invalidate(titles)
+        try:
+            self.compile()
+        except MenuParseError:
+            logging.exception('Invalid menu "%s"' % self.title)
+
+    def delete(self):
+        self.invalidate([self.title])
+        super(Menu, self).delete()
 
     def __unicode__(self):
         return self.title
@@ -147,10 +310,9 @@ class MenuItem(object):
         return lines
     
     @staticmethod
-    def __add_to_menu(menu, items, data):
+    def __add_to_menu(menu, node, data):
         if menu.submenu is None: menu.submenu = []
-        line_no, depth, name, link_type, link = items
-        link_type = link_type.upper()
+        line_no, name, link_type, link, _ = node
         if link_type == 'L':
             new_menu = MenuItem(parent=menu, name=name, link=link)
         elif link_type == 'G':
@@ -165,24 +327,50 @@ class MenuItem(object):
                 raise MenuParseError(line_no, link.lower(), 'Unknown Project')
         menu.submenu.append(new_menu)
         return new_menu
-    
+
     @staticmethod
-    def create(text, data):
-        items = MenuItem.__parse_menu(text)
-        root = current_menu = last_menu = MenuItem()
-        current_depth = 0
-        for item in items:
-            depth = item[1]
-            if depth > current_depth:
-                current_menu = last_menu
-                current_depth += 1
-            else:
-                while depth < current_depth:
-                    current_menu = current_menu.parent
-                    current_depth -= 1
-            last_menu = MenuItem.__add_to_menu(current_menu, item, data)
+    def __add_nodes(menu, nodes, data):
+        for node in nodes:
+            new_menu = MenuItem.__add_to_menu(menu, node, data)
+            if node[4]:
+                MenuItem.__add_nodes(new_menu, node[4], data)
+
+    @staticmethod
+    def compile(text):
+        '''Parses the menu text into a compiled menu tree.
+        
+        Compiled tree is a list of ``(line_no, name, link_type, link, children)``
+        nodes. It holds no model references, so it can be safely cached.
+        '''
+        root  = (None, None, None, None, [])
+        stack = [root]
+        for line_no, depth, name, link_type, link in MenuItem.__parse_menu(text):
+            del stack[depth:]
+            node = (line_no, name, link_type.upper(), link, [])
+            stack[-1][4].append(node)
+            stack.append(node)
+        return root[4]
+
+    @staticmethod
+    def link_types(compiled):
+        '''Returns the set of link types used in the compiled menu tree'''
+        types = set()
+        for _, _, link_type, _, children in compiled:
+            types.add(link_type)
+            types.update(MenuItem.link_types(children))
+        return types
+
+    @staticmethod
+    def build(compiled, data):
+        '''Creates the menu from the compiled tree, resolving G and P links from data'''
+        root = MenuItem()
+        MenuItem.__add_nodes(root, compiled, data)
         return root
 
+    @staticmethod
+    def create(text, data):
+        return MenuItem.build(MenuItem.compile(text), data)
+
     def __init__(self, name=None, link=None, submenu=None, parent=None):
         self.name    = name
         self.link    = link
@@ -190,19 +378,25 @@ class MenuItem(object):
         self.parent  = parent
     
     def spitout(self, first=True):
-        s = ''
+        out = []
+        self._spitout(out, first)
+        return ''.join(out)
+
+    def _spitout(self, out, first):
         if self.submenu:
-            s += '' if first else '<ul>'
+            if not first: out.append('<ul>')
             for i, menu in enumerate(self.submenu):
                 bar = '<span class="bar"></span>' if (i != 0 and first) else ''
                 cls = ' class="first-menu"' if first else ''
-                s += '<li><a%s href="%s">%s%s</a>%s</li>' % (cls, menu.link, bar, menu.name, menu.spitout(False))
-            s += '' if first else '</ul>' 
-        return s
+                out.append('<li><a%s href="%s">%s%s</a>' % (cls, menu.link, bar, menu.name))
+                menu._spitout(out, False)
+                out.append('</li>')
+            if not first: out.append('</ul>')
 
 
 class Program(PerartModelWithTitleAndUrl, models.Model):
-    MENU_CACHE_KEY = 'program-menu' 
+    MENU_CACHE_KEY      = 'program-menu-%s'
+    MENU_HTML_CACHE_KEY = 'program-menu-html-%s'
     FIELD_LIST = [
         {'name': 'title', 'width': 350},
     ]
@@ -216,46 +410,124 @@ class Program(PerartModelWithTitleAndUrl, models.Model):
     menu            = models.ForeignKey(Menu)
     order           = models.IntegerField(default=0)
 
+    # Number of datastore RPCs made by the last menu build
+    menu_rpcs = None
+
+    @staticmethod
+    def invalidate_menu(*program_ids):
+        '''Removes the cached menus and menu html of the programs with the given ids'''
+        keys = []
+        for program_id in program_ids:
+            if program_id is not None:
+                keys.extend([Program.MENU_CACHE_KEY % program_id,
+                             Program.MENU_HTML_CACHE_KEY % program_id])
+        if keys:
+            memcache.delete_multi(keys) #@UndefinedVariable
+
+    @staticmethod
+    def saved_program_ids(obj):
+        '''Returns the ids of the programs linking to obj before and after it's saved'''
+        program_ids = set([obj.program_id])
+        if obj.id is not None:
+            try:
+                program_ids.add(obj.__class__.objects.get(pk=obj.id).program_id)
+            except obj.DoesNotExist: pass
+        return program_ids
+
     def menu_cache_key(self):
-        return 'program-menu-%s' % self.url
+        return Program.MENU_CACHE_KEY % self.id
+
+    def menu_html_cache_key(self):
+        return Program.MENU_HTML_CACHE_KEY % self.id
+
+    def menu_cache_keys(self):
+        return [self.menu_cache_key(), self.menu_html_cache_key()]
 
     def get_menu(self, use_cache=True):
         if use_cache:
             menu = memcache.get(self.menu_cache_key()) #@UndefinedVariable
         else: menu = None
         if menu is None: 
-            data = {'G': {}, 'P': {}}
-            for gallery in self.galleries:
-                data['G'][gallery.title.lower()] = gallery
-            for project in self.projects:
-                data['P'][project.title.lower()] = project
-            menu = self.menu.create(data)
+            counter = RpcCounter().start()
+            try:
+                compiled = self.menu.compile()
+                link_types = MenuItem.link_types(compiled)
+                data = {'G': {}, 'P': {}}
+                # Galleries and projects are fetched with one query each, and
+                # only if the menu links to them. The program is already
+                # loaded, so absolute_url() doesn't have to fetch it again.
+                for kind, name in (('G', 'galleries'), ('P', 'projects')):
+                    if kind in link_types:
+                        for obj in getattr(self, name):
+                            obj.program = self
+                            data[kind][obj.title.lower()] = obj
+                menu = MenuItem.build(compiled, data)
+            finally:
+                self.menu_rpcs = counter.stop()
             memcache.set(self.menu_cache_key(), menu) #@UndefinedVariable
         return menu
 
+    def get_menu_html(self, use_cache=True):
+        if use_cache:
+            html = memcache.get(self.menu_html_cache_key()) #@UndefinedVariable
+        else: html = None
+        if html is None:
+            html = self.get_menu(use_cache).spitout()
+            memcache.set(self.menu_html_cache_key(), html) #@UndefinedVariable
+        return html
+
     def save(self, *args, **kwargs):
-        PerartModelWithTitleAndUrl.save(self)
-        models.Model.save(self, *args, **kwargs)
-        memcache.delete(self.menu_cache_key()) #@UndefinedVariable
+        PerartModelWithTitleAndUrl.save(self, *args, **kwargs)
+        Program.invalidate_menu(self.id)
 
     def delete(self):
-        memcache.delete(self.menu_cache_key()) #@UndefinedVariable
-        for project in Project.objects.filter(program=self):
-            project.program = None
-            project.save()
-        super(Program, self).delete()        
+        '''Deletes the program with its projects, galleries and images.
+        
+        Dependent entities are deleted with batched Deletes, images by keys
+        only, and all the affected cache keys are removed at once. Projects
+        of other programs that show one of the galleries lose their gallery.
+        '''
+        projects  = list(Project.objects.filter(program=self))
+        galleries = list(Gallery.objects.filter(program=self))
+        keys = Gallery.delete_images(galleries)
+        bulk_delete(Project, [project.id for project in projects])
+        # Projects of other programs may show the galleries, their references
+        # are cleared so that their pages don't point to deleted galleries
+        gallery_ids = [gallery.id for gallery in galleries]
+        linked = []
+        if gallery_ids:
+            linked = [project for project in Project.objects.filter(gallery__in=gallery_ids)
+                      if project.program_id != self.id]
+        if linked:
+            Project.objects.filter(pk__in=[project.id for project in linked]).update(gallery=None)
+        bulk_delete(Gallery, gallery_ids)
+        keys.extend(self.menu_cache_keys())
+        for cls, objs in ((Project, projects + linked), (Gallery, galleries)):
+            for obj in objs:
+                key = cls.url_cache_key(obj.url)
+                cls._url_cache.delete(key)
+                keys.append(key)
+        memcache.delete_multi(keys) #@UndefinedVariable
+        invalidate_pages('project', 'gallery', 'image')
+        super(Program, self).delete()
+
 
+    @staticmethod
+    def ordered():
+        '''Returns all the programs in their order, memoized per request'''
+        return memo.query(Program, order_by=('order',))
 
     @property
     def projects(self):
-        return Project.objects.filter(program=self)
+        return memo.query(Project, program=self)
     
     @property
     def galleries(self):
-        return Gallery.objects.filter(program=self)
+        return memo.query(Gallery, program=self)
 
 
 class Gallery(PerartModelWithTitleAndUrl, models.Model):
+    MANIFEST_CACHE_KEY = 'gallery-manifest-%s'
     FIELD_LIST    = [
         {'name': 'title',   'width': 350},
     ]
@@ -268,38 +540,397 @@ class Gallery(PerartModelWithTitleAndUrl, models.Model):
     def images(self):
         return Image.objects.filter(gallery=self)
 
+    @staticmethod
+    def invalidate_manifest(gallery_id):
+        if gallery_id is not None:
+            memcache.delete(Gallery.MANIFEST_CACHE_KEY % gallery_id) #@UndefinedVariable
+
+    def image_list(self, use_cache=True):
+        '''Returns the gallery manifest, image ids and urls.
+        
+        Besides the original ``url``, every rendition has its ``<name>_url``,
+        and the thumbnail its ``thumbnail_width`` and ``thumbnail_height``.
+        The manifest is built with a keys only query and cached until an
+        image of the gallery changes.
+        '''
+        key = Gallery.MANIFEST_CACHE_KEY % self.id
+        result = memcache.get(key) if use_cache else None #@UndefinedVariable
+        if result is None:
+            width, height, crop = Image.RENDITIONS['thumbnail']
+            result = []
+            for id in Image.ids(gallery=self):
+                item = dict(('%s_url' % kind, Image.url_for(id, kind)) for kind in Image.RENDITIONS)
+                item.update({'id': id, 'url': Image.url_for(id),
+                             'thumbnail_width': width, 'thumbnail_height': height})
+                result.append(item)
+            memcache.set(key, result) #@UndefinedVariable
+        return result
+
     def absolute_url(self):
         return reverse('perart.gallery', args=[self.program.url, self.url])
 
+    @staticmethod
+    def delete_images(galleries):
+        '''Deletes the images of the galleries and their data by keys only.
+        
+        Returns the manifest and image blob cache keys, for the caller to
+        remove together with its own.
+        '''
+        image_ids = []
+        for gallery in galleries:
+            image_ids.extend(Image.ids(gallery=gallery))
+        bulk_delete(ImageBlob, [ImageBlob.key(id, kind) for id in image_ids for kind in Image.BLOB_KINDS])
+        bulk_delete(Image, image_ids)
+        keys = [Gallery.MANIFEST_CACHE_KEY % gallery.id for gallery in galleries]
+        keys.extend(Image.blob_cache_key(id, kind) for id in image_ids for kind in Image.BLOB_KINDS)
+        return keys
+
     def save(self, *args, **kwargs):
-        PerartModelWithTitleAndUrl.save(self)
-        models.Model.save(self, *args, **kwargs)
+        # Menu of the old program links to the old url if the gallery moved
+        program_ids = Program.saved_program_ids(self)
+        PerartModelWithTitleAndUrl.save(self, *args, **kwargs)
+        Program.invalidate_menu(*program_ids)
+
+    def delete(self):
+        # Images are deleted here, the cascade wouldn't delete their blobs
+        memcache.delete_multi(Gallery.delete_images([self])) #@UndefinedVariable
+        Program.invalidate_menu(self.program_id)
+        invalidate_pages('image')
+        super(Gallery, self).delete()
+
+
+class ImageBlob(models.Model):
+    '''Image data, stored apart from the Image entity.
+    
+    The original and every rendition have their own entity, whose key name
+    is made from the image id and the kind, so it is fetched with a single
+    Get and only when it's needed.
+    '''
+    id       = models.CharField(max_length=255, primary_key=True)
+    data     = BlobField(null=True, blank=True)
+    hash     = models.CharField(max_length=40, null=True, blank=True)
+    modified = models.DateTimeField(auto_now=True, null=True)
+    # Spec of the rendition the blob was made for, None for originals
+    spec     = models.CharField(max_length=31, null=True, blank=True)
+    width    = models.IntegerField(null=True, blank=True)
+    height   = models.IntegerField(null=True, blank=True)
+    size     = models.IntegerField(null=True, blank=True)
+
+    @staticmethod
+    def key(image_id, kind):
+        return '%s-%s' % (image_id, kind)
+
+    @staticmethod
+    def create(image_id, kind, data, spec=None):
+        blob = ImageBlob(id=ImageBlob.key(image_id, kind), data=data, spec=spec)
+        if data:
+            blob.hash = hashlib.sha1(data).hexdigest()
+            blob.size = len(data)
+            try:
+                img = images.Image(data)
+                blob.width, blob.height = img.width, img.height
+            except images.Error:
+                logging.exception('Unable to read image dimensions')
+        return blob
+
+    def blob(self):
+        return self.hash, self.modified, self.data
 
 
 class Image(PerartModel, models.Model):
-    gallery   = models.ForeignKey(Gallery)
-    image     = BlobField(null=True, blank=True)
-    thumbnail = BlobField(null=True, blank=True) 
+    BLOB_CACHE_KEY = 'image-%s-%s-%s'
+    # Named renditions: name -> (width, height, crop). Renditions that are not
+    # cropped keep the aspect ratio, so their height is ignored. Renditions are
+    # generated when they're first requested, and regenerated if the size
+    # they were made with changes.
+    RENDITIONS = {
+        'thumbnail': (74,   31, True),
+        'small':     (311,   0, False),
+        'medium':    (640,   0, False),
+        'large':     (1024,  0, False),
+    }
+    BLOB_KINDS = ('image',) + tuple(RENDITIONS)
+    # Renditions generated by the background task after upload
+    UPLOAD_RENDITIONS = ('thumbnail', 'small', 'medium')
+    # Uploaded originals can be recompressed to fit the byte budget, and are
+    # never larger than ORIGINAL_MAX_SIZE on either side
+    ORIGINAL_MAX_SIZE    = 2048
+    ORIGINAL_BYTE_BUDGET = 300 * 1024
+    ORIGINAL_QUALITIES   = (90, 80, 70, 60)
+    # Datastore calls are limited in size, so create_many() stores the data
+    # of the images in Puts of at most this many bytes
+    BLOB_PUT_SIZE = 900 * 1024
+    # Rendition processing states
+    PENDING = 'pending'
+    READY   = 'ready'
+    FAILED  = 'failed'
 
-    def create_thumbnail(self, width=74, height=31):
-        img = images.Image(self.image)
-        img.im_feeling_lucky()
-        img_width, img_height = img.width, img.height
-        if img_width / width < img_height / height:
+    gallery          = models.ForeignKey(Gallery)
+    status           = models.CharField(max_length=15, default=READY)
+    # Size of the uploaded file, before it was compacted
+    upload_size      = models.IntegerField(null=True, blank=True)
+    # Images uploaded before ImageBlob existed keep the data on the entity,
+    # it's moved to ImageBlob entities the next time the image is saved
+    legacy_image     = BlobField(null=True, blank=True, db_column='image')
+    legacy_thumbnail = BlobField(null=True, blank=True, db_column='thumbnail')
+
+    @staticmethod
+    def spec(kind):
+        '''Returns the spec of the rendition, or None for the original'''
+        if kind not in Image.RENDITIONS:
+            return None
+        width, height, crop = Image.RENDITIONS[kind]
+        return '%sx%s%s' % (width, height, 'c' if crop else '')
+
+    @staticmethod
+    def rendition_for(width):
+        '''Returns the smallest rendition at least width wide, or the original'''
+        sizes = sorted([(w, name) for name, (w, h, crop) in Image.RENDITIONS.items() if not crop])
+        for w, name in sizes:
+            if w >= width:
+                return name
+        return 'image'
+
+    @staticmethod
+    def render(data, width, height, crop):
+        img = images.Image(data)
+        if crop:
+            img.im_feeling_lucky()
+            img_width, img_height = img.width, img.height
+            if img_width / width < img_height / height:
+                img.resize(width=width)
+                new_height = round((float(width) / img_width) * img_height)
+                img.crop(0.0, 0.0, 1.0, height/new_height)
+            else:
+                img.resize(height=height)
+                new_width = round((float(height) / img_height) * img_width)
+                img.crop(0.0, 0.0, width/new_width, 1.0)
+        elif img.width > width:
             img.resize(width=width)
-            new_height = round((float(width) / img_width) * img_height)
-            img.crop(0.0, 0.0, 1.0, height/new_height)
         else:
-            img.resize(height=height)
-            new_width = round((float(height) / img_height) * img_width)
-            img.crop(0.0, 0.0, width/new_width, 1.0)
-        self.thumbnail = img.execute_transforms(output_encoding=images.JPEG)
+            # Never upscale, the original is the best rendition
+            return data
+        return img.execute_transforms(output_encoding=images.JPEG)
+
+    @staticmethod
+    def compact(data):
+        '''Returns the image recompressed to fit the byte budget.
+        
+        Re-encoding strips the metadata, and the orientation is corrected if
+        the images API supports it. The lowest quality is kept if none fits,
+        and the data is returned as is if it can't be made smaller. Only JPEG
+        images are recompressed, others would lose transparency or animation.
+        '''
+        result = data
+        try:
+            if images.Image(data).format != images.JPEG:
+                return data
+            for quality in Image.ORIGINAL_QUALITIES:
+                img = images.Image(data)
+                if hasattr(img, 'set_correct_orientation'):
+                    img.set_correct_orientation(images.CORRECT_ORIENTATION)
+                img.resize(width=min(img.width, Image.ORIGINAL_MAX_SIZE),
+                           height=min(img.height, Image.ORIGINAL_MAX_SIZE))
+                result = img.execute_transforms(output_encoding=images.JPEG, quality=quality)
+                if len(result) <= Image.ORIGINAL_BYTE_BUDGET:
+                    break
+        except images.Error:
+            logging.exception('Unable to compact image')
+            return data
+        return result if len(result) < len(data) else data
 
-    def url(self):
-        return reverse('perart.image', args=[self.id])
+    @staticmethod
+    def blob_cache_key(id, kind):
+        return Image.BLOB_CACHE_KEY % (id, kind, Image.spec(kind))
+
+    @staticmethod
+    def invalidate_blobs(id):
+        memcache.delete_multi([Image.blob_cache_key(id, kind) for kind in Image.BLOB_KINDS]) #@UndefinedVariable
+
+    @classmethod
+    def get_blob(cls, id, kind, use_cache=True):
+        '''Returns the ``(etag, modified, data)`` tuple for the image blob.
+        
+        Tuple is cached in memcache. Data is cached only for renditions, for
+        the original image data is None if it came from the cache, but the
+        etag can still be used to answer conditional requests.
+        '''
+        key = cls.blob_cache_key(id, kind)
+        if use_cache:
+            blob = memcache.get(key) #@UndefinedVariable
+        else: blob = None
+        if blob is None:
+            blob = cls.load_blob(id, kind)
+            memcache.set(key, blob if kind != 'image' else blob[:2] + (None,)) #@UndefinedVariable
+        return blob
+
+    @classmethod
+    def load_blob(cls, id, kind):
+        '''Loads the blob from the datastore.
+        
+        Renditions which are missing, or were made for an outdated size, are
+        generated from the original and stored.
+        '''
+        try:
+            blob = ImageBlob.objects.get(pk=ImageBlob.key(id, kind))
+            if blob.spec == cls.spec(kind):
+                return blob.blob()
+        except ImageBlob.DoesNotExist:
+            if kind == 'image':
+                blob = cls.objects.get(pk=id).legacy_blob()
+                if not blob[2]:
+                    raise cls.DoesNotExist('Image %s has no data' % id)
+                return blob
+        original = cls.get_blob(id, 'image', use_cache=False)[2]
+        if not original:
+            raise cls.DoesNotExist('Image %s has no data' % id)
+        blob = ImageBlob.create(id, kind, cls.render(original, *cls.RENDITIONS[kind]), cls.spec(kind))
+        blob.save()
+        return blob.blob()
+
+    def legacy_blob(self):
+        data = self.legacy_image
+        return data and hashlib.sha1(data).hexdigest(), None, data
+
+    def _get_data(self, kind):
+        blobs = self.__dict__.setdefault('_blobs', {})
+        if kind not in blobs:
+            blobs[kind] = None if self.id is None else Image.get_blob(self.id, kind, False)[2]
+        return blobs[kind]
+
+    def _set_data(self, kind, data):
+        self.__dict__.setdefault('_blobs', {})[kind] = data
+        self.__dict__.setdefault('_dirty', set()).add(kind)
+
+    def compact_original(self):
+        '''Recompresses the original with compact(), its size before is kept in upload_size'''
+        data = self.image
+        if not data:
+            return
+        self.upload_size = len(data)
+        compacted = Image.compact(data)
+        if compacted is not data:
+            self.image = compacted
+            logging.info('Image %s compacted from %s to %s bytes' % (self.id, len(data), len(compacted)))
+
+    image     = property(lambda self: self._get_data('image'),
+                         lambda self, data: self._set_data('image', data))
+    thumbnail = property(lambda self: self._get_data('thumbnail'),
+                         lambda self, data: self._set_data('thumbnail', data))
+
+    @staticmethod
+    def ids(**filters):
+        '''Returns the ids of the matching images, using a keys only query'''
+        return list(Image.objects.filter(**filters).values_list('id', flat=True))
+
+    @staticmethod
+    def create_many(gallery, contents):
+        '''Creates pending images from the uploaded contents.
+        
+        Images are stored with one batched Put, and their data with as few
+        Puts as BLOB_PUT_SIZE allows. If storing the data fails, the images
+        are removed again.
+        '''
+        images = []
+        for content in contents:
+            image = Image(gallery=gallery, status=Image.PENDING)
+            image.image = content
+            images.append(image)
+        bulk_insert(images)
+        try:
+            batch, size = [], 0
+            for image in images:
+                if batch and size + len(image.image) > Image.BLOB_PUT_SIZE:
+                    bulk_insert(batch)
+                    batch, size = [], 0
+                batch.append(ImageBlob.create(image.id, 'image', image.image))
+                size += len(image.image)
+            bulk_insert(batch)
+        except:
+            # Images without data would stay pending forever
+            bulk_delete(ImageBlob, [ImageBlob.key(image.id, 'image') for image in images])
+            bulk_delete(Image, [image.id for image in images])
+            raise
+        Gallery.invalidate_manifest(gallery.id)
+        invalidate_pages('image')
+        return images
+
+    def save(self, *args, **kwargs):
+        created = self.id is None
+        dirty = self.__dict__.pop('_dirty', set())
+        if self.legacy_image is not None and 'image' not in dirty:
+            self.__dict__.setdefault('_blobs', {})['image'] = self.legacy_image
+            dirty.add('image')
+        if created:
+            # Blobs are keyed by the image id, so new images are stored first
+            self.legacy_image = self.legacy_thumbnail = None
+            super(Image, self).save(*args, **kwargs)
+        for kind in dirty:
+            ImageBlob.create(self.id, kind, self._blobs[kind], Image.spec(kind)).save()
+        if not created:
+            # Legacy data is cleared only after it's stored in ImageBlob, the
+            # legacy thumbnail is dropped, it's regenerated from the original
+            self.legacy_image = self.legacy_thumbnail = None
+            super(Image, self).save(*args, **kwargs)
+        if 'image' in dirty and not created:
+            # Renditions of the old original are outdated
+            bulk_delete(ImageBlob, [ImageBlob.key(self.id, kind) for kind in Image.BLOB_KINDS
+                                    if kind not in dirty])
+        Image.invalidate_blobs(self.id)
+        if created:
+            Gallery.invalidate_manifest(self.gallery_id)
+        invalidate_pages('image')
+
+    def delete(self):
+        bulk_delete(ImageBlob, [ImageBlob.key(self.id, kind) for kind in Image.BLOB_KINDS])
+        Image.invalidate_blobs(self.id)
+        super(Image, self).delete()
+        Gallery.invalidate_manifest(self.gallery_id)
+        invalidate_pages('image')
+
+    def create_thumbnail(self, width=74, height=31):
+        self.thumbnail = Image.render(self.image, width, height, True)
+
+    @staticmethod
+    def url_for(id, kind=None):
+        if kind is None or kind == 'image':
+            return reverse('perart.image', args=[id])
+        return reverse('perart.image', args=[id, kind])
+
+    @staticmethod
+    def thumbnail_url_for(id):
+        return Image.url_for(id, 'thumbnail')
+
+    def url(self, kind=None):
+        return Image.url_for(self.id, kind)
 
     def thumbnail_url(self):
-        return reverse('perart.image', args=[self.id, 'thumbnail'])
+        return Image.thumbnail_url_for(self.id)
+
+
+def generate_renditions(*image_ids, **kwargs):
+    '''Deferred task, generates the renditions of the uploaded images.
+    
+    With compact=True the originals are recompressed first, so the
+    renditions are made from the compacted data.
+    '''
+    compact = kwargs.get('compact', False)
+    # Images removed before the task was run are skipped
+    for image in Image.objects.filter(pk__in=image_ids):
+        try:
+            # upload_size is set once the original is compacted, so retries
+            # of the task don't compact it again
+            if compact and image.upload_size is None:
+                image.compact_original()
+                image.save()
+            for kind in Image.UPLOAD_RENDITIONS:
+                Image.get_blob(image.id, kind, use_cache=False)
+            image.status = Image.READY
+        except (images.Error, Image.DoesNotExist):
+            # Failed images are not retried, the task would fail again
+            logging.exception('Generating renditions of image %s failed' % image.id)
+            image.status = Image.FAILED
+        image.save()
 
 
 class Project(PerartModelWithTitleAndUrl, models.Model):
@@ -318,11 +949,23 @@ class Project(PerartModelWithTitleAndUrl, models.Model):
         return reverse('perart.project', args=[self.program.url, self.url])
 
     def save(self, *args, **kwargs):
-        PerartModelWithTitleAndUrl.save(self)
-        models.Model.save(self, *args, **kwargs)
+        # Menu of the old program links to the old url if the project moved
+        program_ids = Program.saved_program_ids(self)
+        PerartModelWithTitleAndUrl.save(self, *args, **kwargs)
+        Program.invalidate_menu(*program_ids)
+
+    def delete(self):
+        Program.invalidate_menu(self.program_id)
+        super(Project, self).delete()
 
 
 class News(PerartModelWithTitleAndUrl, models.Model):
+    TITLES_CACHE_KEY  = 'news-titles-%s-%s'
+    ARCHIVE_CACHE_KEY = 'news-archive-%s'
+    MONTH_CACHE_KEY   = 'news-month-%s-%s-%s'
+    TITLES_PAGE_SIZE = 20
+    MONTHS = ['januar', 'februar', 'mart', 'april', 'maj', 'jun', 'jul',
+              'avgust', 'septembar', 'oktobar', 'novembar', 'decembar']
     FIELD_LIST = [
         {'name': 'title',     'width': 350},
         {'name': 'published', 'width': 120}
@@ -332,39 +975,132 @@ class News(PerartModelWithTitleAndUrl, models.Model):
     url       = models.CharField(max_length=511, null=True, blank=True)
     text      = models.TextField(null=True, blank=True)
     published = models.DateField(null=True, blank=True)
+    # Derived from published on save
+    date_label = models.CharField(max_length=31, null=True, blank=True, editable=False)
+    year       = models.IntegerField(null=True, blank=True, editable=False)
+    month      = models.IntegerField(null=True, blank=True, editable=False)
+
+    @staticmethod
+    def month_label(year, month):
+        return '%s %s.' % (News.MONTHS[month-1], year)
 
     def date(self):
-        return '%s %s.' % (
-                ['januar', 'februar', 'mart', 'april', 'maj', 'jun', 'jul',
-                 'avgust', 'septembar', 'oktobar', 'novembar', 'decembar'][self.published.month-1],
-                 self.published.year)
+        # News saved before the labels were stored don't have them
+        if self.date_label is None and self.published is not None:
+            return News.month_label(self.published.year, self.published.month)
+        return self.date_label
+
+    @staticmethod
+    def _title(news):
+        return {'title': news.title, 'url': news.url, 'published': news.published, 'date': news.date()}
+
+    @staticmethod
+    def titles(cursor=None, count=TITLES_PAGE_SIZE):
+        '''Returns a page of the newest news, and the cursor of the next page.
+        
+        News are returned as lightweight title/url/published dicts. Pages are
+        cached until any news changes, so the text bodies are only loaded on
+        a cache miss. The cursor of the last page is None.
+        '''
+        key = News.TITLES_CACHE_KEY % (page_versions('news')[0], cursor or '')
+        page = memcache.get(key) #@UndefinedVariable
+        if page is None:
+            queryset = News.objects.order_by('-published')
+            if cursor:
+                queryset = set_cursor(queryset, start=cursor)
+            queryset = queryset[:count]
+            titles = [News._title(news) for news in queryset]
+            page = (titles, get_cursor(queryset) if len(titles) == count else None)
+            memcache.set(key, page) #@UndefinedVariable
+        return page
+
+    @staticmethod
+    def archive():
+        '''Returns the year/month buckets of all the news, newest first.
+        
+        Buckets are dicts with year, month, label and count, cached until any
+        news changes.
+        '''
+        key = News.ARCHIVE_CACHE_KEY % page_versions('news')[0]
+        buckets = memcache.get(key) #@UndefinedVariable
+        if buckets is None:
+            counts = {}
+            for year, month in News.objects.filter(year__gt=0).values_list('year', 'month'):
+                counts[(year, month)] = counts.get((year, month), 0) + 1
+            buckets = [{'year': year, 'month': month, 'count': counts[(year, month)],
+                        'label': News.month_label(year, month)}
+                       for year, month in sorted(counts, reverse=True)]
+            memcache.set(key, buckets) #@UndefinedVariable
+        return buckets
+
+    @staticmethod
+    def month_titles(year, month):
+        '''Returns the news published in the month, using the archive index'''
+        key = News.MONTH_CACHE_KEY % (page_versions('news')[0], year, month)
+        titles = memcache.get(key) #@UndefinedVariable
+        if titles is None:
+            queryset = News.objects.filter(year=year, month=month).order_by('-published')
+            titles = [News._title(news) for news in queryset]
+            memcache.set(key, titles) #@UndefinedVariable
+        return titles
 
     def save(self, *args, **kwargs):
-        PerartModelWithTitleAndUrl.save(self)
-        models.Model.save(self, *args, **kwargs)
+        if self.published is None:
+            self.date_label = self.year = self.month = None
+        else:
+            self.year, self.month = self.published.year, self.published.month
+            self.date_label = News.month_label(self.year, self.month)
+        PerartModelWithTitleAndUrl.save(self, *args, **kwargs)
 
 
 class Settings(models.Model):
     MAIN_PAGE = 'main_page'
+    VERSION_CACHE_KEY  = 'settings-version'
+    SNAPSHOT_CACHE_KEY = 'settings-snapshot'
+    # The snapshot is kept in process memory, and compared with the version
+    # in memcache only after it expires
+    SNAPSHOT_LOCAL_TIME = 10
+    _snapshot = (None, None, {}) # (version, expires, values)
     
     key   = models.CharField(max_length=255)
     value = models.TextField(default='')
 
+    @staticmethod
+    def snapshot():
+        '''Returns the dict of all the settings.
+        
+        The snapshot is loaded with one batched memcache get, and rebuilt with
+        a single query if the version changed. Reading never writes.
+        '''
+        version, expires, values = Settings._snapshot
+        if expires is not None and expires > time.time():
+            return values
+        cached = memcache.get_multi([Settings.VERSION_CACHE_KEY, Settings.SNAPSHOT_CACHE_KEY]) #@UndefinedVariable
+        version = cached.get(Settings.VERSION_CACHE_KEY)
+        snapshot = cached.get(Settings.SNAPSHOT_CACHE_KEY)
+        if version is not None and snapshot is not None and snapshot[0] == version:
+            values = snapshot[1]
+        else:
+            if version is None:
+                version = int(time.time() * 1000)
+                memcache.add(Settings.VERSION_CACHE_KEY, version) #@UndefinedVariable
+            values = dict((pair.key, pair.value) for pair in Settings.objects.all())
+            memcache.set(Settings.SNAPSHOT_CACHE_KEY, (version, values)) #@UndefinedVariable
+        Settings._snapshot = (version, time.time() + Settings.SNAPSHOT_LOCAL_TIME, values)
+        return values
+
     @staticmethod
     def get_object(name):
-        obj = memcache.get('settings-%s' % name)
-        if obj is None:
-            pair, _ = Settings.objects.get_or_create(key=name)
-            obj = pair.value
-            memcache.set('settings-%s' % name, obj)
-        return obj
+        return Settings.snapshot().get(name, '')
     
     @staticmethod
     def set_object(name, value):
         pair, _ = Settings.objects.get_or_create(key=name)
         pair.value = value
         pair.save()
-        memcache.delete('settings-%s' % name) #@UndefinedVariable
+        memcache.incr(Settings.VERSION_CACHE_KEY, initial_value=int(time.time() * 1000)) #@UndefinedVariable
+        Settings._snapshot = (None, None, {})
+        invalidate_pages('settings')
 
     @staticmethod
     def MainPage():
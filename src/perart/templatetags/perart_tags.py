@@ -4,12 +4,28 @@ __date__      = '07 May 2009'
 __copyright__ = 'Copyright (c) 2009 Viktor Kerkez'
 
 from django import template
+from django.utils import simplejson
 
 register = template.Library()
 
+# Thumbnails rendered with the page, the rest are added on demand
+GALLERY_PAGE_SIZE = 24
+
 
 @register.inclusion_tag('perart/templatetags/render_gallery.html')
-def render_gallery(gallery):
-    '''Render a complete gallery'''
-    images = gallery.images
-    return { 'images': images, 'count': len(images) }
+def render_gallery(gallery, per_page=GALLERY_PAGE_SIZE):
+    '''Render a complete gallery.
+    
+    Only the first page of thumbnails is rendered, the rest of the manifest
+    is embedded as JSON and shown when the visitor asks for more.
+    '''
+    images = gallery.image_list()
+    rest = [{'thumbnail': image['thumbnail_url'], 'small': image['small_url']}
+            for image in images[per_page:]]
+    return {
+        'images'   : images[:per_page],
+        'count'    : len(images),
+        'gallery'  : gallery,
+        'rest'     : simplejson.dumps(rest).replace('</', '<\\/'),
+        'has_more' : len(rest) > 0,
+    }
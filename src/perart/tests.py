@@ -0,0 +1,32 @@
+from django.test import TestCase
+
+from perart.models import Menu, Program, Gallery, Project
+
+MENU_TEXT = '''
+-Galleries
+--First<G:First>
+--Second<G:Second>
+-Projects
+--One<P:One>
+--Two<P:Two>
+'''
+
+
+class MenuRpcBudgetTest(TestCase):
+    def setUp(self):
+        menu = Menu(title='main', text=MENU_TEXT)
+        menu.save()
+        program = Program(title='Program', subtitle='Subtitle', menu=menu)
+        program.save()
+        for title in ('First', 'Second'):
+            Gallery(program=program, title=title).save()
+        for title in ('One', 'Two'):
+            Project(program=program, title=title).save()
+        self.program_id = program.id
+
+    def test_menu_rpcs(self):
+        program = Program.objects.get(pk=self.program_id)
+        menu = program.get_menu(use_cache=False)
+        self.assertEqual([len(item.submenu) for item in menu.submenu], [2, 2])
+        # Menu row, galleries and projects, one datastore RPC each
+        self.assertTrue(program.menu_rpcs <= 3, program.menu_rpcs)
@@ -45,7 +45,9 @@ urlpatterns = patterns('perart.views',
     # Gallery
     url(r'^gallery-edit/(?:(?P<id>\d+)/)?$',    'admin.gallery.edit',         name='perart.admin.gallery.edit'),
     url(r'^gallery-upload-image/(?P<id>\d+)/$', 'admin.gallery.upload_image', name='perart.admin.gallery.upload_image'),    
+    url(r'^gallery-upload-images/(?P<id>\d+)/$', 'admin.gallery.upload_images', name='perart.admin.gallery.upload_images'),
     url(r'^gallery-remove-image/$',             'admin.gallery.remove_image', name='perart.admin.gallery.remove_image'),
+    url(r'^gallery-image-status/$',             'admin.gallery.image_status', name='perart.admin.gallery.image_status'),
 
     # Settings
     url(r'^settings-main-page-edit/', 'admin.settings.main_page_edit', name='perart.admin.settings.main_page_edit'),
@@ -10,7 +10,9 @@ urlpatterns = patterns('perart.views',
     url(r'^contact/$',                                             'cms.contact',     name='perart.contact'),
     url(r'^blob/(?P<model>\w+)/(?P<field>\w+)/(?P<id>\d+)/$',      'cms.blob',        name='perart.blob'),
     url(r'^news/(?:(?P<url>[\w-]+)/)?$',                           'cms.news',        name='perart.news'),
-    url(r'^image/(?P<key>[\w-]+)/(?:(?P<thumbnail>thumbnail)/)?$', 'cms.image',       name='perart.image'),
+    url(r'^news/(?P<year>\d{4})/(?P<month>\d{1,2})/$',              'cms.news_archive', name='perart.news_archive'),
+    url(r'^image/(?P<key>[\w-]+)/w(?P<width>\d+)/$',               'cms.image_width', name='perart.image_width'),
+    url(r'^image/(?P<key>[\w-]+)/(?:(?P<kind>[a-z]+)/)?$',         'cms.image',       name='perart.image'),
     url(r'^(?P<url>[\w-]+)/$',                                     'cms.program',     name='perart.program'),
     url(r'^(?P<program_url>[\w-]+)/g/(?P<gallery_url>[\w-]+)/$',   'cms.gallery',     name='perart.gallery'),
     url(r'^(?P<program_url>[\w-]+)/(?P<project_url>[\w-]+)/$',     'cms.project',     name='perart.project'),
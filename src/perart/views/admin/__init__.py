@@ -7,26 +7,63 @@ import logging
 
 from google.appengine.api import images
 from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
 
 from django.utils import simplejson
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
 from django.shortcuts import render_to_response
 from django.http import HttpResponse, Http404, HttpResponseRedirect
+from django.db.models import ForeignKey
+from djangoappengine.db.utils import get_cursor, set_cursor
 
 from tea.gae.decorators import admin_required
 from perart.models import Program, Project, News, Image, Menu
 from perart.forms import ProgramForm, ProjectForm, NewsForm
 
+# Number of objects on an admin list page
+OBJECT_LIST_PAGE_SIZE = 50
+
 # Admin interface
 
+def load_related(model, objects, field_names):
+    '''Loads the objects referenced by the foreign keys with one batch Get per field'''
+    for name in field_names:
+        field = model._meta.get_field(name)
+        if not isinstance(field, ForeignKey) or not objects:
+            continue
+        ids = set([getattr(obj, field.attname) for obj in objects]) - set([None])
+        related = field.rel.to.objects.filter(pk__in=list(ids))
+        if 'title' in [f.name for f in field.rel.to._meta.fields]:
+            related = related.only('title')
+        related = dict((obj.pk, obj) for obj in related)
+        for obj in objects:
+            if getattr(obj, field.attname) in related:
+                setattr(obj, name, related[getattr(obj, field.attname)])
+
+
 @admin_required
-def object_list(request, queryset, template_name='perart/admin/object_list.html', extra_content=None):
+def object_list(request, queryset, template_name='perart/admin/object_list.html', extra_content=None,
+                per_page=OBJECT_LIST_PAGE_SIZE):
+    '''Lists the objects a page at a time, loading only the FIELD_LIST columns'''
     data       = {} if extra_content is None else extra_content.copy()
     model      = queryset.im_self.model().__class__
     model_name = model.__name__
+    field_names = [field['name'] for field in model.FIELD_LIST]
+    objects = queryset().only(*field_names)
+    cursor = request.GET.get('cursor')
+    try:
+        if cursor:
+            objects = set_cursor(objects, start=cursor)
+        objects = objects[:per_page]
+        object_list = list(objects)
+    except datastore_errors.BadValueError:
+        raise Http404('Invalid cursor!')
+    load_related(model, object_list, field_names)
     data.update({
-        'object_list' : queryset(),
+        'object_list' : object_list,
+        'cursor'      : cursor,
+        'next_cursor' : get_cursor(objects) if len(object_list) == per_page else None,
         'model'       : model,
         'model_name'  : model_name,
         'page'        : model_name.lower(),
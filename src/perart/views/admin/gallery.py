@@ -5,16 +5,23 @@ __copyright__ = 'Copyright (c) 2010 Viktor Kerkez'
 
 import logging
 
+from google.appengine.ext import deferred
+
+from django.conf import settings
 from django.utils import simplejson
 from django.template import RequestContext
 from django.shortcuts import render_to_response
 from django.http import Http404, HttpResponse, HttpResponseRedirect
 
 from tea.gae.decorators import admin_required
+from tea.django.http import JsonResponse
 
-from perart.models import Gallery, Image
+from perart.models import Gallery, Image, generate_renditions
 from perart.forms import GalleryForm
 
+# Maximum size of an uploaded image
+MAX_FILE_SIZE = 1048576
+
 
 @admin_required
 def edit(request, id=None):
@@ -28,7 +35,7 @@ def edit(request, id=None):
                 obj = f.save()
                 return HttpResponseRedirect(Gallery.get_list_url() + ('?saved=%s' % obj.id))
         if obj is not None:
-            images = simplejson.dumps(map(lambda x: {'id': x.id, 'thumbnail': x.thumbnail_url()}, list(obj.images)))
+            images = simplejson.dumps([{'id': x['id'], 'thumbnail': x['thumbnail_url']} for x in obj.image_list()])
         else:
             images = simplejson.dumps([])
         data = {
@@ -43,23 +50,52 @@ def edit(request, id=None):
         raise Http404('Gallery not found')
 
 
+def read_upload(uploaded, max_size=MAX_FILE_SIZE):
+    '''Reads the uploaded file chunk by chunk, returns None if it's too big'''
+    if uploaded.size > max_size:
+        return None
+    chunks, size = [], 0
+    for chunk in uploaded.chunks():
+        size += len(chunk)
+        if size > max_size:
+            return None
+        chunks.append(chunk)
+    return ''.join(chunks)
+
+
+def compact_originals():
+    '''Uploaded originals are recompressed unless IMAGE_COMPACT_ORIGINALS is off'''
+    return getattr(settings, 'IMAGE_COMPACT_ORIGINALS', True)
+
+
 @admin_required
 def upload_image(request, id):
     try:
         gallery = Gallery.objects.get(pk=id)
         if request.method == 'POST':
-            MAX_FILE_SIZE = 1048576
             data = { 'status': '', 'key': '', 'thumbnail': ''}
-            if not 'file' in request.FILES or request.FILES.get('file').size > MAX_FILE_SIZE:
+            content = read_upload(request.FILES['file']) if 'file' in request.FILES else None
+            if content is None:
                 data['status'] = 'ERROR'
-                return render_to_response('teacupcms/upload_response.html', data, context_instance=RequestContext(request))
-            image = Image(gallery=gallery)
+                return render_to_response('perart/admin/upload_response.html', data, context_instance=RequestContext(request))
+            image = Image(gallery=gallery, status=Image.PENDING)
             try:
-                image.image = request.FILES.get('file').read()
-                image.create_thumbnail()
+                image.image = content
                 image.save()
+                # Original is compacted and renditions are generated in the
+                # background, the admin polls image_status until it's ready
+                deferred.defer(generate_renditions, image.id, compact=compact_originals(),
+                               _queue=getattr(settings, 'IMAGE_QUEUE_NAME', 'default'))
             except:
                 logging.exception('Exception in saving image...')
+                # Image without data or a task would stay pending forever
+                if image.id is not None:
+                    try:
+                        image.delete()
+                    except:
+                        logging.exception('Unable to remove the image %s' % image.id)
+                data['status'] = 'ERROR'
+                return render_to_response('perart/admin/upload_response.html', data, context_instance=RequestContext(request))
             data.update({'status': 'OK', 'id': image.id, 'thumbnail': image.thumbnail_url()})
             return render_to_response('perart/admin/upload_response.html', data, context_instance=RequestContext(request))
         raise Http404('Invalid request method!')
@@ -68,6 +104,58 @@ def upload_image(request, id):
         
 
 
+@admin_required
+def upload_images(request, id):
+    '''Uploads all the files from the request.
+    
+    Images and their data are stored with one batched Put each, and the
+    renditions of all the images are generated by a single deferred task.
+    '''
+    try:
+        gallery = Gallery.objects.get(pk=id)
+    except Gallery.DoesNotExist:
+        raise Http404('Gallery not found')
+    if request.method != 'POST':
+        raise Http404('Invalid request method!')
+    results, accepted, contents = [], [], []
+    for uploaded in request.FILES.getlist('file'):
+        result = {'name': uploaded.name, 'status': 'ERROR', 'id': '', 'thumbnail': ''}
+        results.append(result)
+        content = read_upload(uploaded)
+        if content is not None:
+            accepted.append(result)
+            contents.append(content)
+    if contents:
+        images = []
+        try:
+            images = Image.create_many(gallery, contents)
+            deferred.defer(generate_renditions, *[image.id for image in images],
+                           **{'compact': compact_originals(),
+                              '_queue': getattr(settings, 'IMAGE_QUEUE_NAME', 'default')})
+            for result, image in zip(accepted, images):
+                result.update({'status': 'OK', 'id': image.id, 'thumbnail': image.thumbnail_url()})
+        except:
+            logging.exception('Exception in saving images...')
+            # Images without a task would stay pending forever
+            for image in images:
+                try:
+                    image.delete()
+                except:
+                    logging.exception('Unable to remove the image %s' % image.id)
+    # Results are embedded in a script, so closing tags must be escaped
+    results = simplejson.dumps(results).replace('</', '<\\/')
+    return render_to_response('perart/admin/upload_images_response.html', {'results': results},
+                              context_instance=RequestContext(request))
+
+
+@admin_required
+def image_status(request):
+    '''Returns the rendition processing status of the images in the ids parameter'''
+    ids = [int(id) for id in request.GET.get('ids', '').split(',') if id.isdigit()]
+    images = Image.objects.filter(pk__in=ids) if ids else []
+    return JsonResponse(dict((image.id, image.status) for image in images))
+
+
 @admin_required
 def remove_image(request):
     try:
@@ -5,43 +5,158 @@ __contact__   = 'alefnula@gmail.com'
 __date__      = '26 January 2010'
 __copyright__ = 'Copyright (c) 2010 Viktor Kerkez'
 
+import re
+import hashlib
+import calendar
 from datetime import datetime
 
-from google.appengine.api import memcache
+from google.appengine.api import memcache, datastore_errors, images
 import logging
 from django.template import RequestContext
 from django.shortcuts import render_to_response
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
 from django.core.urlresolvers import reverse
 
+from tea.gae.cache import cache_page
+
 from perart.models import Program, Project, News, Image, Menu, Gallery, Settings
 from perart.forms import NewsletterForm
 
+# Data behind an image url changes when the original is compacted after
+# upload, or a rendition is regenerated for a new size, so browsers must
+# revalidate it. Revalidation is answered from the cached etag.
+BLOB_CACHE_TIME = 0
+# Blobs are sent in chunks of this size
+BLOB_CHUNK_SIZE = 64 * 1024
+# Only single byte ranges are supported, others are ignored
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# Models the cached pages depend on, the models invalidate their tag on save
+PAGE_TAGS = ('program', 'project', 'gallery', 'menu', 'image')
+INDEX_TAGS = ('program', 'project', 'gallery', 'menu', 'news', 'settings')
+NEWS_TAGS = ('program', 'news')
 
+
+@cache_page(*INDEX_TAGS)
 def index(request):
     return render_to_response('perart/cms/index.html', {
-                                  'programs' : Program.objects.order_by('order'),
-                                  'menu'     : Menu.objects.get(title='main').create(),
+                                  'programs' : Program.ordered(),
+                                  'menu'     : Menu.get_html('main'),
                                   'text'     : Settings.MainPage(),
                                   'news'     : News.objects.all().order_by('-published')[:15]
                               }, context_instance=RequestContext(request))
 
-def render_blob(title, blob):
-    response = HttpResponse(blob, mimetype='image/jpeg')
+def blob_size(blob):
+    '''Returns the size of BlobField data, a BlobstoreFile or a BlobReader'''
+    if isinstance(blob, str):
+        return len(blob)
+    if hasattr(blob, 'blob_info'):
+        return blob.blob_info.size
+    return blob.size
+
+
+def iter_blob(blob, start, end, chunk_size=BLOB_CHUNK_SIZE):
+    '''Yields the bytes from start to end of the blob, chunk by chunk'''
+    if isinstance(blob, str):
+        for offset in xrange(start, end, chunk_size):
+            yield blob[offset:min(offset + chunk_size, end)]
+    else:
+        blob.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = blob.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def parse_range(header, size):
+    '''Returns the (start, end) byte range requested by the Range header.
+    
+    Returns None if the whole blob should be sent, and raises ValueError if
+    the range can't be satisfied.
+    '''
+    match = RANGE_RE.match(header.strip()) if header else None
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        if int(last) == 0:
+            raise ValueError('Empty suffix range')
+        return max(size - int(last), 0), size
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError('Range starts after the end of the blob')
+    return start, min(int(last) + 1, size) if last else size
+
+
+def render_blob(request, title, blob, etag=None, mimetype='image/jpeg'):
+    '''Streams the blob in chunks, honoring single range requests'''
+    size = blob_size(blob)
+    byte_range = None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range is None or (etag is not None and if_range == quote_etag(etag)):
+        try:
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%s' % size
+            return response
+    start, end = byte_range or (0, size)
+    response = HttpResponse(iter_blob(blob, start, end), mimetype=mimetype,
+                            status=206 if byte_range else 200)
+    if byte_range:
+        response['Content-Range'] = 'bytes %s-%s/%s' % (start, end - 1, size)
+    response['Content-Length'] = str(end - start)
+    response['Accept-Ranges'] = 'bytes'
     response['Content-disposition'] = 'filename="%s"' % title.encode('utf-8')
     return response
 
 
+def not_modified(request, etag, modified):
+    '''Checks the conditional request headers against the etag and modification time'''
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = parse_etags(if_none_match)
+        return etag is not None and (etag in etags or '*' in etags)
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_modified_since is not None and modified is not None:
+        return calendar.timegm(modified.utctimetuple()) <= if_modified_since
+    return False
+
+
+def set_cache_headers(response, etag, modified, max_age=BLOB_CACHE_TIME):
+    if etag is not None:
+        response['ETag'] = quote_etag(etag)
+    if modified is not None:
+        response['Last-Modified'] = http_date(calendar.timegm(modified.utctimetuple()))
+    response['Cache-Control'] = 'public, max-age=%s' % max_age
+    return response
+
+
 def blob(request, model, field, id):
     model = model.lower()
     if model == 'program':
         try:
             obj = Program.objects.get(pk=id)
-            return render_blob(obj.title, getattr(obj, field))
+            data = getattr(obj, field, None)
+            if isinstance(data, str):
+                # Program images can be replaced, so browsers must revalidate
+                etag = hashlib.md5(data).hexdigest()
+                if not_modified(request, etag, None):
+                    return set_cache_headers(HttpResponseNotModified(), etag, None, max_age=0)
+                return set_cache_headers(render_blob(request, obj.title, data, etag), etag, None, max_age=0)
         except Program.DoesNotExist: pass
     raise Http404('Image not found!')
 
 
+@cache_page(*PAGE_TAGS)
 def program(request, url=None):
     program = Program.get_by_url(url)
     if program is None:
@@ -50,6 +165,7 @@ def program(request, url=None):
                               context_instance=RequestContext(request))
 
 
+@cache_page(*PAGE_TAGS)
 def gallery(request, program_url, gallery_url):
     program = Program.get_by_url(program_url)
     gallery = Gallery.get_by_url(gallery_url)
@@ -59,6 +175,7 @@ def gallery(request, program_url, gallery_url):
                               context_instance=RequestContext(request))
 
 
+@cache_page(*PAGE_TAGS)
 def project(request, program_url, project_url):
     program = Program.get_by_url(program_url)
     project = Project.get_by_url(project_url)
@@ -68,25 +185,69 @@ def project(request, program_url, project_url):
                               context_instance=RequestContext(request))
 
 
-def image(request, key, thumbnail=None):
+def image(request, key, kind=None):
+    kind = kind or 'image'
+    if kind not in Image.BLOB_KINDS:
+        raise Http404('Image not found!')
     try:
-        image = Image.objects.get(pk=key)
-        if thumbnail == 'thumbnail':
-            return render_blob(image.gallery.title, image.thumbnail)
-        else:
-            return render_blob(image.gallery.title, image.image)
+        etag, modified, data = Image.get_blob(key, kind)
+        if not_modified(request, etag, modified):
+            return set_cache_headers(HttpResponseNotModified(), etag, modified)
+        if data is None:
+            etag, modified, data = Image.get_blob(key, kind, use_cache=False)
     except Image.DoesNotExist:
         raise Http404('Image not found!')
+    except images.Error:
+        # Renditions of broken uploads can't be generated
+        logging.warning('Unable to render %s of image %s' % (kind, key))
+        raise Http404('Image not found!')
+    return set_cache_headers(render_blob(request, u'%s.jpg' % key, data, etag), etag, modified)
 
 
+def image_width(request, key, width):
+    '''Serves the smallest rendition that is at least width pixels wide'''
+    return image(request, key, Image.rendition_for(int(width)))
+
+
+@cache_page(*NEWS_TAGS)
 def news(request, url=None):
-    all_news = News.objects.order_by('-published')
+    cursor = request.GET.get('cursor')
+    try:
+        titles, next_cursor = News.titles(cursor)
+    except datastore_errors.BadValueError:
+        raise Http404('Invalid cursor!')
     if url is None:
-        news = all_news[0]
-    else:
-        news = News.get_by_url(url)
-    return render_to_response('perart/cms/news.html', {'object': news, 'news': all_news, 'programs': Program.objects.order_by('order')},
-                              context_instance=RequestContext(request))
+        if not titles:
+            raise Http404('News not found!')
+        url = titles[0]['url']
+    news = News.get_by_url(url)
+    if news is None:
+        raise Http404('News not found!')
+    return render_to_response('perart/cms/news.html', {
+                                  'object'      : news,
+                                  'news'        : titles,
+                                  'archive'     : News.archive(),
+                                  'cursor'      : cursor,
+                                  'next_cursor' : next_cursor,
+                                  'programs'    : Program.ordered(),
+                              }, context_instance=RequestContext(request))
+
+
+@cache_page(*NEWS_TAGS)
+def news_archive(request, year, month):
+    year, month = int(year), int(month)
+    titles = News.month_titles(year, month) if 1 <= month <= 12 else []
+    if not titles:
+        raise Http404('News not found!')
+    news = News.get_by_url(titles[0]['url'])
+    if news is None:
+        raise Http404('News not found!')
+    return render_to_response('perart/cms/news.html', {
+                                  'object'   : news,
+                                  'news'     : titles,
+                                  'archive'  : News.archive(),
+                                  'programs' : Program.ordered(),
+                              }, context_instance=RequestContext(request))
 
 
 def contact(request):
@@ -111,7 +272,7 @@ def contact(request):
         form = NewsletterForm()
         message = ''
     return render_to_response('perart/cms/contact.html', {
-               'programs'  : Program.objects.order_by('order'),
+               'programs'  : Program.ordered(),
                'form'      : form,
                'message'   : message,
                'succeeded' : succeeded,
@@ -75,6 +75,7 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'tea.django.memo.QueryMemoMiddleware',
 #    'django.middleware.doc.XViewMiddleware',
 )
 
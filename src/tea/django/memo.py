@@ -0,0 +1,78 @@
+import logging
+import threading
+
+from django.conf import settings
+
+_local = threading.local()
+
+
+class QueryMemo(object):
+    '''Request scoped memo of query results with an identity map.
+
+    Identical queries are executed only once, and every entity is represented
+    by a single model instance, whichever query loaded it.
+    '''
+    def __init__(self):
+        self.queries = {}
+        self.objects = {}
+        self.hits    = 0
+        self.misses  = 0
+
+    def register(self, obj):
+        key = (type(obj), obj.pk)
+        return self.objects.setdefault(key, obj)
+
+    def query(self, key, queryset):
+        try:
+            results = self.queries[key]
+            self.hits += 1
+        except KeyError:
+            results = self.queries[key] = [self.register(obj) for obj in queryset]
+            self.misses += 1
+        return results
+
+
+def current():
+    '''Returns the memo of the current request, or None outside of requests'''
+    return getattr(_local, 'memo', None)
+
+
+def query(model, order_by=(), **filters):
+    '''Returns the list of model objects matching the filters.
+
+    Filter values must be hashable. Outside of requests the query is always
+    executed.
+
+    Usage:
+    >>> query(Program, order_by=('order',))
+    >>> query(Project, program=program)
+    '''
+    queryset = model.objects.filter(**filters)
+    if order_by:
+        queryset = queryset.order_by(*order_by)
+    memo = current()
+    if memo is None:
+        return list(queryset)
+    key = (model, tuple(order_by), tuple(sorted(filters.items())))
+    return memo.query(key, queryset)
+
+
+class QueryMemoMiddleware(object):
+    '''Activates the query memo for GET requests.
+
+    Other requests may change the data, so they are never memoized. Hit and
+    miss counts are available as request.query_memo, and in DEBUG mode they
+    are also sent in the X-Query-Memo response header.
+    '''
+    def process_request(self, request):
+        _local.memo = QueryMemo() if request.method == 'GET' else None
+        request.query_memo = _local.memo
+
+    def process_response(self, request, response):
+        memo = current()
+        _local.memo = None
+        if memo is not None:
+            logging.debug('Query memo: %s hits, %s misses' % (memo.hits, memo.misses))
+            if settings.DEBUG:
+                response['X-Query-Memo'] = 'hits=%s misses=%s' % (memo.hits, memo.misses)
+        return response
@@ -0,0 +1,73 @@
+import time
+import threading
+
+from tea.dsa.ordereddict import OrderedDict
+
+
+class LRUCache(object):
+    '''Bounded mapping that evicts the least recently used items.
+
+    Items can optionally expire after ttl seconds.
+
+    Usage:
+    >>> cache = LRUCache(2)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', 2)
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)  # evicts 'b', it's the least recently used
+    >>> cache.get('b') is None
+    True
+    '''
+    def __init__(self, size, ttl=None):
+        self.size  = size
+        self.ttl   = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            # Reinsert the item so it becomes the most recently used
+            self._data[key] = (expires, value)
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._data)
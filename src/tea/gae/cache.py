@@ -0,0 +1,88 @@
+import time
+import hashlib
+import functools
+
+from google.appengine.api import memcache
+from django.http import HttpResponse
+
+from tea.dsa.lru import LRUCache
+
+PAGE_CACHE_KEY = 'page-%s'
+TAG_CACHE_KEY  = 'page-tag-%s'
+# Process local tier in front of memcache, it's only cleared on the instance
+# that made the change, so entries expire quickly
+_local = LRUCache(128, ttl=10)
+
+
+def _tag_key(tag):
+    return TAG_CACHE_KEY % tag
+
+
+def _initial_version():
+    # Tags evicted from memcache must not start counting from the same value
+    # again, or the pages rendered before the eviction would become valid
+    return int(time.time() * 1000)
+
+
+def invalidate(*tags):
+    '''Invalidates all the cached pages that depend on any of the tags'''
+    for tag in tags:
+        memcache.incr(_tag_key(tag), initial_value=_initial_version()) #@UndefinedVariable
+    _local.clear()
+
+
+def versions(*tags):
+    '''Returns the current versions of the tags'''
+    keys = [_tag_key(tag) for tag in tags]
+    found = memcache.get_multi(keys) #@UndefinedVariable
+    missing = dict((key, _initial_version()) for key in keys if key not in found)
+    if missing:
+        memcache.add_multi(missing) #@UndefinedVariable
+        found.update(memcache.get_multi(missing.keys())) #@UndefinedVariable
+    return tuple([found.get(key) for key in keys])
+
+
+def cache_page(*tags, **kwargs):
+    '''Caches the rendered pages of the view, keyed by the request url.
+
+    Pages are stored in memcache together with the versions of the tags they
+    depend on, and are valid until any of the tags is invalidated. A hit costs
+    a single memcache call, or none if the page is in the local tier. Only
+    GET requests without a query string are cached.
+
+    Usage:
+    >>> @cache_page('program', 'news')
+    ... def news(request, url=None):
+    ...     ...
+    >>> invalidate('news')
+    '''
+    timeout = kwargs.get('timeout', 0)
+    tag_keys = [_tag_key(tag) for tag in tags]
+    def decorator(function):
+        @functools.wraps(function)
+        def cache_page_wrapper(request, *args, **kw):
+            if request.method not in ('GET', 'HEAD') or request.META.get('QUERY_STRING'):
+                return function(request, *args, **kw)
+            url = '%s%s' % (request.get_host(), request.path)
+            key = PAGE_CACHE_KEY % hashlib.md5(url.encode('utf-8')).hexdigest()
+            entry = _local.get(key)
+            if entry is None:
+                cached = memcache.get_multi([key] + tag_keys) #@UndefinedVariable
+                entry = cached.get(key)
+                if entry is not None and entry[0] == tuple([cached.get(k) for k in tag_keys]):
+                    _local.set(key, entry)
+                else:
+                    entry = None
+            if entry is not None:
+                return HttpResponse(entry[1], content_type=entry[2])
+            # Versions are read before rendering, so a change made during the
+            # rendering invalidates the stored page
+            tag_versions = versions(*tags)
+            response = function(request, *args, **kw)
+            if response.status_code == 200 and not response.cookies:
+                entry = (tag_versions, response.content, response['Content-Type'])
+                memcache.set(key, entry, time=timeout) #@UndefinedVariable
+                _local.set(key, entry)
+            return response
+        return cache_page_wrapper
+    return decorator
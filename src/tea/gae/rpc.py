@@ -0,0 +1,39 @@
+import threading
+
+from google.appengine.api import apiproxy_stub_map
+
+_HOOK_NAME = 'tea-rpc-counter'
+_local = threading.local()
+
+
+def _count_rpc(service, call, request, response):
+    for counter in getattr(_local, 'counters', ()):
+        if counter.service is None or counter.service == service:
+            counter.count += 1
+
+
+class RpcCounter(object):
+    '''Counts the API calls made by the current thread while it's running.
+
+    Usage:
+    >>> counter = RpcCounter('datastore_v3').start()
+    >>> Program.objects.get(pk=1)
+    >>> counter.stop()
+    1
+    '''
+    def __init__(self, service='datastore_v3'):
+        self.service = service
+        self.count   = 0
+
+    def start(self):
+        # Append does nothing if the hook is already installed
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(_HOOK_NAME, _count_rpc)
+        if not hasattr(_local, 'counters'):
+            _local.counters = []
+        _local.counters.append(self)
+        return self
+
+    def stop(self):
+        if self in _local.counters:
+            _local.counters.remove(self)
+        return self.count